@@ -0,0 +1,297 @@
+import argparse
+import cmed_index
+import csv
+import etl_functions as etl
+import instrumentation as instr
+import ir_med
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+
+# Benchmark of the IR-Med stages over synthetic CMED reports and notices. Runs offline:
+#
+#   python benchmark.py --scales 1000 10000 100000 --items 100 --output bench.json
+#   python benchmark.py --scales 1000 --compare bench.json
+
+
+
+# Columns of the CMED report, as published
+CMED_COLUMNS = ['SUBSTÂNCIA', 'CNPJ', 'LABORATÓRIO', 'CÓDIGO GGREM', 'REGISTRO', 'EAN 1', 'EAN 2', 'EAN 3',
+                'PRODUTO', 'APRESENTAÇÃO', 'CLASSE TERAPÊUTICA', 'TIPO DE PRODUTO (STATUS DO PRODUTO)',
+                'REGIME DE PREÇO', 'PF Sem Impostos', 'PF 18%', 'PMC 18%', 'RESTRIÇÃO HOSPITALAR', 'TARJA']
+
+INGREDIENTS = ['aciclovir', 'amoxicilina', 'metronidazol', 'carbidopa', 'carvedilol', 'escetamina', 'clonazepam',
+               'dexametasona', 'dexclorfeniramina', 'dimenidrinato', 'dipirona', 'petidina', 'enoxaparina',
+               'espironolactona', 'formoterol', 'hidroclorotiazida', 'hidrocortisona', 'haloperidol', 'meloxicam',
+               'meropenem', 'metoclopramida', 'midazolam', 'ondansetrona', 'oxcarbazepina', 'ocitocina',
+               'piperacilina', 'sulbactam', 'sulfametoxazol', 'tenoxicam', 'trimetoprima', 'paracetamol',
+               'ibuprofeno', 'omeprazol', 'metformina', 'captopril', 'enalapril', 'losartana', 'sinvastatina',
+               'atenolol', 'furosemida', 'glicose', 'diclofenaco', 'fluoxetina', 'heparina', 'ceftriaxona',
+               'ciprofloxacino', 'azitromicina', 'prednisona', 'prednisolona', 'tramadol', 'morfina', 'fentanila',
+               'levotiroxina', 'amiodarona', 'cefalexina', 'clindamicina', 'vancomicina', 'fenitoina', 'insulina']
+
+SALTS = ['cloridrato de', 'sulfato de', 'fosfato dissódico de', 'maleato de', 'acetato de', 'besilato de']
+
+SYLLABLES = ['pra', 'zo', 'li', 'cil', 'ta', 'mi', 'na', 'fe', 'rol', 'do', 'xa', 'ce', 'tri', 'bu', 'pro', 'ne',
+             'mo', 'lo', 'ri', 'va', 'ti', 'co', 'sar', 'dil']
+
+# (CMED form, notice form, unit of the notice)
+FORMS = [('COM', 'comprimido', 'comprimido'),
+         ('COM REV', 'comprimido revestido', 'comprimido'),
+         ('CAP DURA', 'cápsula dura', 'cápsula'),
+         ('SOL INJ', 'solução injetável', 'ampola'),
+         ('SUS OR', 'suspensão oral', 'frasco'),
+         ('CREM DERM', 'creme dermatológico', 'bisnaga'),
+         ('SOL OR GOT', 'solução oral gotas', 'frasco'),
+         ('XPE', 'xarope', 'frasco')]
+
+PACKAGES = {'COM': 'CT BL AL PLAS TRANS X {n}',
+            'COM REV': 'CT BL AL PLAS TRANS X {n}',
+            'CAP DURA': 'CT BL AL PLAS INC X {n}',
+            'SOL INJ': 'CT {n} AMP VD AMB X {v} ML',
+            'SUS OR': 'CT FR VD AMB X {v} ML',
+            'CREM DERM': 'CT BG AL X {v} G',
+            'SOL OR GOT': 'CT FR PLAS OPC GOT X {v} ML',
+            'XPE': 'CT FR VD AMB X {v} ML + COP'}
+
+STRENGTHS = [1, 2, 4, 5, 10, 20, 25, 40, 50, 100, 200, 250, 500, 750, 1000]
+LABORATORIES = ['EMS S/A', 'MEDLEY FARMACÊUTICA LTDA', 'EUROFARMA LABORATÓRIOS S.A.', 'HYPOFARMA', 'CRISTÁLIA',
+                'BRAINFARMA', 'PRATI DONADUZZI & CIA LTDA', 'GERMED FARMACEUTICA LTDA', 'NEO QUÍMICA']
+
+
+
+# Ingredients of a synthetic CMED: the real ones above, their salts, some combinations and enough
+# made up names to get about one ingredient for every 20 rows
+def generate_ingredients(n_rows, rng):
+    ingredients = INGREDIENTS + [salt + ' ' + ai for ai in INGREDIENTS[::3] for salt in rng.sample(SALTS, 2)]
+    ingredients += [a + ' + ' + b for a, b in zip(rng.sample(INGREDIENTS, 10), rng.sample(INGREDIENTS, 10)) if a != b]
+
+    while len(ingredients) < n_rows // 20:
+        ingredients.append("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(3, 5))))
+
+    return ingredients
+
+
+
+# Writes a CMED shaped .csv with n_rows rows. Returns, for each row, the (ingredient, strength, form)
+def generate_cmed(path, n_rows, seed = 0):
+    rng = random.Random(seed)
+    ingredients = generate_ingredients(n_rows, rng)
+    rows = []
+
+    with open(path, 'w', newline = '', encoding = 'utf-8') as f:
+        writer = csv.writer(f, delimiter = ';')
+        writer.writerow(CMED_COLUMNS)
+
+        for i in range(n_rows):
+            ai = rng.choice(ingredients)
+            strength = rng.choice(STRENGTHS)
+            form = rng.choice(FORMS)
+            unit = 'MG/ML' if form[0] in ('SOL INJ', 'SUS OR', 'SOL OR GOT', 'XPE') else 'MG/G' if form[0] == 'CREM DERM' else 'MG'
+            presentation = str(strength) + ' ' + unit + ' ' + form[0] + ' ' + \
+                PACKAGES[form[0]].format(n = rng.choice([1, 10, 20, 30, 50, 100]), v = rng.choice([2, 5, 10, 30, 100, 120]))
+            price = rng.uniform(1, 500)
+
+            writer.writerow([ai.upper(), '%08d/0001-%02d' % (rng.randrange(10 ** 8), rng.randrange(100)),
+                             rng.choice(LABORATORIES), str(500000000000 + i), str(100000000 + rng.randrange(10 ** 8)),
+                             str(7890000000000 + i), '-', '-', ai.split()[-1].upper(), presentation,
+                             'N02B - ANALGESICOS', rng.choice(['Genérico', 'Similar', 'Novo']), 'Regulado',
+                             ('%.2f' % price).replace('.', ','), ('%.2f' % (price * 1.2)).replace('.', ','),
+                             ('%.2f' % (price * 1.6)).replace('.', ','), rng.choice(['Sim', 'Não']),
+                             rng.choice(['Tarja Vermelha', 'Tarja Preta', '- (*)'])])
+            rows.append((ai, strength, form))
+
+    return rows
+
+
+
+# Writes a notice shaped .csv with n_items items taken from the CMED rows, written the way the
+# notices write them, with the known misspellings of etl.CORRECOES in about 'typo_rate' of them
+def generate_notice(path, cmed_rows, n_items, seed = 0, typo_rate = 0.2):
+    rng = random.Random(seed)
+    misspellings = {}
+    for wrong, right in etl.CORRECOES.items():
+        misspellings.setdefault(right, []).append(wrong)
+
+    with open(path, 'w', newline = '', encoding = 'utf-8') as f:
+        writer = csv.writer(f, delimiter = ',')
+        writer.writerow(['item', 'desc', 'und', 'quant', 'valor_unit', 'valor_total'])
+
+        for i in range(n_items):
+            ai, strength, form = rng.choice(cmed_rows)
+            words = ai.split()
+            words = [rng.choice(misspellings[w]) if w in misspellings and rng.random() < typo_rate else w for w in words]
+
+            desc = " ".join(words).capitalize() + rng.choice([' ', ' (', ' - ']) + str(strength) + rng.choice(['mg', ' mg', 'MG']) + \
+                (')' if rng.random() < 0.3 else '') + ' ' + form[1]
+            quant = rng.randint(1, 100000)
+            price = rng.uniform(0.01, 50)
+
+            writer.writerow([i + 1, desc, form[2].capitalize(), quant, ('%.2f' % price).replace('.', ','),
+                             ('R$%.2f' % (quant * price)).replace('.', ',')])
+
+
+
+# Runs func once and returns its result, the wall time and, if trace_memory, the peak of memory
+# allocated by Python during the call (in MB)
+def measure(func, trace_memory = False):
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    return result, seconds, peak
+
+
+
+# Benchmarks every stage over a CMED of n_rows rows and a notice of n_items items
+def run_scale(n_rows, n_items, workdir, seed = 0, trace_memory = True):
+    cmed_path = os.path.join(workdir, 'cmed_%d.csv' % n_rows)
+    notice_path = os.path.join(workdir, 'notice_%d.csv' % n_rows)
+
+    cmed_rows = generate_cmed(cmed_path, n_rows, seed)
+    generate_notice(notice_path, cmed_rows, n_items, seed)
+
+    results = []
+    state = {}
+
+    def item_loop(func):
+        return lambda : [func(desc_ai, desc_pr, und) for desc_ai, desc_pr, und in state['items']]
+
+    def rows_of(key):
+        return state['grouped_cmed'][state['grouped_cmed']['key'] == key].reset_index()['indexes'][0]
+
+    def prepare_items():
+        df_notice = etl.load_notice(notice_path, drop_columns = ['item', 'valor_total'], desc_column = 0, und_column = 1,
+                                    sep = ',', preprocess = True)
+        state['items'] = [ir_med.sep_desc(row['desc'], state['cmed_ai_words'], state['cmed_pr_words']) + (row['und'],)
+                          for _, row in df_notice.iterrows()]
+
+    def match_items():
+        state['ais'] = [ir_med.match_ai(state['grouped_cmed'], desc_ai)[0] for desc_ai, _, _ in state['items']]
+
+    stages = [('load_cmed', n_rows, lambda : state.__setitem__('df_cmed', etl.load_cmed(cmed_path, preprocess = True))),
+              ('load_cmed_lean', n_rows, lambda : etl.load_cmed(cmed_path, preprocess = True, columns = etl.CMED_MATCH_COLUMNS)),
+              ('tokenize', n_rows, lambda : [etl.tokenize(pr) for pr in state['df_cmed']['apresentacao']]),
+              ('grouped_cmed', n_rows, lambda : state.__setitem__('grouped_cmed', etl.grouped_cmed(state['df_cmed']))),
+              ('extract_cmed_words', n_rows, lambda : state.update(zip(('cmed_ai_words', 'cmed_pr_words'),
+                                                                       ir_med.extract_cmed_words(state['df_cmed'])))),
+              ('load_notice', n_items, prepare_items),
+              ('match_ai', n_items, match_items),
+              ('filter_prs', n_items, lambda : [ir_med.filter_prs(state['df_cmed'].iloc[rows_of(ai)], desc_ai, desc_pr, und, ai)
+                                                for (desc_ai, desc_pr, und), ai in zip(state['items'], state['ais'])]),
+              ('predict', n_items, item_loop(lambda desc_ai, desc_pr, und :
+                                             ir_med.predict(state['df_cmed'], state['grouped_cmed'], desc_ai, desc_pr, und))),
+              ('build_index', n_rows, lambda : state.__setitem__('index', cmed_index.cmed_index_from_dataframe(state['df_cmed']))),
+              ('predict_indexed', n_items, item_loop(lambda desc_ai, desc_pr, und : state['index'].predict(desc_ai, desc_pr, und)))]
+
+    for stage, units, func in stages:
+        _, seconds, _ = measure(func)
+
+        # Memory is measured in a second run, since tracing slows the allocations down
+        peak = measure(func, trace_memory = True)[2] if trace_memory else None
+
+        results.append({'scale': n_rows,
+                        'stage': stage,
+                        'units': units,
+                        'seconds': seconds,
+                        'throughput': units / seconds if seconds else None,
+                        'peak_memory_mb': peak})
+
+        print("%8d  %-20s %10.4f s  %12.1f units/s  %s" % (n_rows, stage, seconds, results[-1]['throughput'] or 0,
+                                                            '%.1f MB' % peak if peak is not None else ''))
+
+    return results
+
+
+
+# Time taken by a fresh interpreter to import the modules (best of 'repeat' runs)
+def measure_startup(modules = 'pipeline', repeat = 5):
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import ' + modules], check = True,
+                       cwd = os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - start)
+
+    seconds = min(times)
+    print("%8d  %-20s %10.4f s" % (0, 'startup', seconds))
+
+    return [{'scale': 0, 'stage': 'startup', 'units': 1, 'seconds': seconds, 'throughput': 1 / seconds, 'peak_memory_mb': None}]
+
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+
+# Prints how much slower (> 1) or faster (< 1) each stage is than in a previous results file
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['scale'], r['stage']): r for r in json.load(f)['results']}
+
+    print("\n   scale  stage                 ratio")
+    for r in results:
+        previous = baseline.get((r['scale'], r['stage']))
+        if previous and previous['seconds']:
+            print("%8d  %-20s %6.2fx" % (r['scale'], r['stage'], r['seconds'] / previous['seconds']))
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark of the IR-Med stages over synthetic data")
+    parser.add_argument('--scales', type = int, nargs = '+', default = [1000, 10000, 100000], help = "CMED sizes (rows)")
+    parser.add_argument('--items', type = int, default = 100, help = "notice items per scale")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no-memory', action = 'store_true', help = "skip the peak memory measurement")
+    parser.add_argument('--output', default = 'bench_results.json', help = "where to write the results")
+    parser.add_argument('--compare', help = "results file of a previous run to compare with")
+    args = parser.parse_args()
+
+    # Only the report is printed
+    instr.set_progress(False)
+
+    results = measure_startup()
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_rows in args.scales:
+            results.extend(run_scale(n_rows, args.items, workdir, args.seed, not args.no_memory))
+
+    report = {'commit': git_commit(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'seed': args.seed,
+              'items': args.items,
+              'results': results}
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+
+if __name__ == '__main__':
+    main()
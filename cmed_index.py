@@ -0,0 +1,415 @@
+import etl_functions as etl
+import hashlib
+import ir_med
+import json
+import os
+import shutil
+
+np = etl.lazy_import('numpy')
+pd = etl.lazy_import('pandas')
+
+
+
+# Version of the on-disk layout. Bump it whenever the stored arrays change
+FORMAT_VERSION = 2
+
+MANIFEST_FILE = 'manifest.json'
+
+# Columns that identify a CMED row across releases
+CMED_KEY_COLUMNS = ['registro', 'ean_1']
+
+
+
+# Everything 'predict' needs about a CMED release, already preprocessed
+class CmedIndex:
+
+    def __init__(self, df_cmed, grouped_cmed, cmed_ai_words, cmed_pr_words, pr_token_ids, pr_token_offsets, fingerprint):
+        self.df_cmed = df_cmed                      # Preprocessed 'principio_ativo' and 'apresentacao' columns
+        self.grouped_cmed = grouped_cmed            # GroupedCmed (grouped_cmed.to_frame() for the DataFrame)
+        self.cmed_ai_words = cmed_ai_words          # Vocabulary of the pharmaceutical ingredients
+        self.cmed_pr_words = cmed_pr_words          # Vocabulary of the presentations
+        self.pr_token_ids = pr_token_ids            # Tokens of every presentation, as positions in cmed_pr_words
+        self.pr_token_offsets = pr_token_offsets    # Row i owns pr_token_ids[offsets[i]:offsets[i+1]]
+        self.fingerprint = fingerprint
+        self.presentation_index = ir_med.PresentationIndex(cmed_pr_words, pr_token_ids, pr_token_offsets, df_cmed.index)
+        self.filter_dosage = False                  # Narrow the presentations by the dosages of the items
+        self._ingredient_index = None
+        self._spelling_corrector = None
+        self._dosage_index = None
+
+
+    # The IngredientIndex is only built when the first item is predicted
+    @property
+    def ingredient_index(self):
+        if self._ingredient_index is None:
+            self._ingredient_index = ir_med.IngredientIndex(self.grouped_cmed)
+
+        return self._ingredient_index
+
+
+    # SpellingCorrector of the pharmaceutical ingredients, built on first use
+    @property
+    def spelling_corrector(self):
+        if self._spelling_corrector is None:
+            self._spelling_corrector = ir_med.build_spelling_corrector(self.df_cmed)
+
+        return self._spelling_corrector
+
+
+    # DosageIndex of the presentations, built on first use
+    @property
+    def dosage_index(self):
+        if self._dosage_index is None:
+            self._dosage_index = ir_med.build_dosage_index(self.df_cmed, self.grouped_cmed)
+
+        return self._dosage_index
+
+
+    # Fingerprint of the predictions, which change when the dosages narrow the presentations
+    @property
+    def prediction_fingerprint(self):
+        return self.fingerprint + ('+dosage' if self.filter_dosage else '')
+
+
+    # Returns the tokens of the presentation stored in the CMED row 'row'
+    def presentation_tokens(self, row):
+        ids = self.pr_token_ids[self.pr_token_offsets[row]:self.pr_token_offsets[row + 1]]
+        return self.cmed_pr_words[ids].tolist()
+
+
+    def predict(self, desc_ai, desc_pr, und):
+        return ir_med.predict(self.df_cmed, self.grouped_cmed, desc_ai, desc_pr, und,
+                              self.ingredient_index, self.presentation_index, self._active_dosage_index())
+
+
+    # Same as predict for many items, with the pharmaceutical ingredients matched in a single
+    # ir_med.match_ai_batch call
+    def predict_batch(self, descs_ai, descs_pr, unds):
+        results = []
+        dosage_index = self._active_dosage_index()
+
+        for (active_ingredient, _), desc_ai, desc_pr, und in zip(ir_med.match_ai_batch(self.grouped_cmed, descs_ai),
+                                                                  descs_ai, descs_pr, unds):
+            df_cmed_filtered = self.df_cmed.iloc[self.grouped_cmed.key_rows(active_ingredient)]
+            results.append(ir_med.filter_prs(df_cmed_filtered, desc_ai, desc_pr, und, active_ingredient,
+                                             self.presentation_index, dosage_index))
+
+        return results
+
+
+    def _active_dosage_index(self):
+        return self.dosage_index if self.filter_dosage else None
+
+
+
+# Hash of the preprocessing settings, so that changing them invalidates the stored indexes
+def settings_fingerprint():
+    settings = {'format_version': FORMAT_VERSION,
+                'ai_preprocessing': etl.CMED_AI_PREPROCESSING,
+                'pr_preprocessing': etl.CMED_PR_PREPROCESSING,
+                'correcoes': etl.CORRECOES,
+                'stopwords_ai': sorted(etl.STOPWORDS_AI),
+                'stopwords_pr': sorted(etl.STOPWORDS_PR),
+                'abreviator': etl.ABREVIATOR}
+
+    return hashlib.sha256(json.dumps(settings, sort_keys = True).encode()).hexdigest()
+
+
+
+# Hash of the contents of the CMED .csv
+def file_fingerprint(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+
+# Hash of the preprocessed columns of a CMED DataFrame, for indexes created in memory
+def dataframe_fingerprint(df_cmed):
+    hashes = pd.util.hash_pandas_object(df_cmed[['principio_ativo', 'apresentacao']]).values
+    return hashlib.sha256(hashes.tobytes() + settings_fingerprint().encode()).hexdigest()
+
+
+
+# Creates the index of a CMED already loaded and preprocessed with etl.load_cmed, without storing it
+def cmed_index_from_dataframe(df_cmed, fingerprint = None):
+    grouped_cmed = etl.build_grouped_cmed(df_cmed)
+    cmed_ai_words, cmed_pr_words = ir_med.extract_cmed_words(df_cmed)
+
+    # Tokenize each distinct presentation once and store its tokens as positions in the vocabulary
+    pr_codes, pr_uniques = pd.factorize(df_cmed['apresentacao'])
+    unique_tokens = [np.searchsorted(cmed_pr_words, etl.tokenize(pr)).astype(np.int32) for pr in pr_uniques]
+    row_tokens = [unique_tokens[code] for code in pr_codes]
+
+    pr_token_offsets = np.zeros(len(row_tokens) + 1, dtype = np.int64)
+    pr_token_offsets[1:] = np.cumsum([len(tokens) for tokens in row_tokens])
+    pr_token_ids = np.concatenate(row_tokens) if row_tokens else np.zeros(0, dtype = np.int32)
+
+    if fingerprint is None:
+        fingerprint = dataframe_fingerprint(df_cmed)
+
+    return CmedIndex(df_cmed, grouped_cmed, cmed_ai_words, cmed_pr_words, pr_token_ids, pr_token_offsets, fingerprint)
+
+
+
+# Key of each CMED row: its registration and EAN, plus a counter for the rows that share them
+def row_keys(df_cmed):
+    keys = (df_cmed['registro'].astype(str) + '|' + df_cmed['ean_1'].astype(str)).reset_index(drop = True)
+    return (keys + '|' + keys.groupby(keys).cumcount().astype(str)).tolist()
+
+
+
+# Hash of the raw (not preprocessed) ingredient and presentation of each CMED row
+def raw_hashes(df_cmed):
+    return pd.util.hash_pandas_object(df_cmed[etl.CMED_MATCH_COLUMNS], index = False).values
+
+
+
+# Builds the index of a CMED release and stores it in the directory 'index_dir'
+def build_cmed_index(path, index_dir):
+    df_raw = etl.load_cmed(path, columns = etl.CMED_MATCH_COLUMNS + CMED_KEY_COLUMNS)
+
+    print("Preprocessing CMED")
+    df_cmed = etl.preprocess_cmed(df_raw[etl.CMED_MATCH_COLUMNS].copy())
+    index = cmed_index_from_dataframe(df_cmed)
+
+    return _write_index(path, index_dir, index, row_keys(df_raw), raw_hashes(df_raw))
+
+
+
+# Updates the index stored in 'index_dir' to the CMED release in 'path'. Rows are matched with the
+# previous release by row_keys, and only the added and changed ones are preprocessed. The grouped
+# index, the vocabularies and the presentation tokens are patched from the stored ones. Returns
+# the new index and a report with the number of added, changed, removed and unchanged rows, the
+# 'ingredients' whose rows changed and, for each row, its position in the previous release
+# ('previous_rows', -1 for added or changed rows)
+def update_cmed_index(path, index_dir):
+    manifest = _read_manifest(index_dir)
+
+    if manifest is None or manifest['settings_fingerprint'] != settings_fingerprint():
+        return build_cmed_index(path, index_dir), None
+
+    old = _read_index(index_dir, manifest)
+    old_keys = _load_strings(index_dir, manifest, 'row_keys')
+    old_hashes = np.load(os.path.join(index_dir, 'raw_hashes.npy'))
+
+    df_raw = etl.load_cmed(path, columns = etl.CMED_MATCH_COLUMNS + CMED_KEY_COLUMNS)
+    keys = row_keys(df_raw)
+    hashes = raw_hashes(df_raw)
+
+    # Rows of the new release found unchanged in the previous one
+    previous_rows = pd.Index(old_keys).get_indexer(keys)
+    found = previous_rows >= 0
+    same = np.zeros(len(keys), dtype = bool)
+    same[found] = old_hashes[previous_rows[found]] == hashes[found]
+    previous_rows[~same] = -1
+    kept = previous_rows[same]
+
+    # Preprocess only the rows that are new or changed
+    print("Preprocessing %d new or changed CMED rows" % (~same).sum())
+    df_new = etl.preprocess_cmed(df_raw.loc[~same, etl.CMED_MATCH_COLUMNS].copy())
+
+    df_cmed = pd.DataFrame(index = df_raw.index)
+    for column in etl.CMED_MATCH_COLUMNS:
+        values = np.empty(len(df_raw), dtype = object)
+        values[same] = np.asarray(old.df_cmed[column], dtype = object)[kept]
+        values[~same] = np.asarray(df_new[column], dtype = object)
+        df_cmed[column] = values
+
+    # Grouped index: ingredients already known keep their alphabetically sorted form
+    old_grouped = old.grouped_cmed
+    old_row_groups = np.empty(len(old_keys), dtype = np.int64)
+    old_row_groups[old_grouped.rows] = np.repeat(np.arange(len(old_grouped)), np.diff(old_grouped.offsets))
+    old_ais = np.asarray(old.df_cmed['principio_ativo'], dtype = object)
+    sorted_keys = dict(zip(old_ais[kept], old_grouped.keys_sorted[old_row_groups[kept]]))
+
+    grouped_cmed = etl.build_grouped_cmed(df_cmed, sorted_keys)
+
+    # Vocabularies: the ingredient words are those of the sorted keys, the presentation words are
+    # those still used by unchanged rows plus the ones of new and changed rows
+    cmed_ai_words = ir_med.Vocabulary(tok for key_sorted in grouped_cmed.keys_sorted for tok in etl.tokenize(key_sorted))
+
+    new_prs = pd.unique(df_new['apresentacao'].astype(object))
+    new_pr_tokens = {pr: etl.tokenize(pr) for pr in new_prs}
+
+    old_starts = old.pr_token_offsets[:-1]
+    old_lengths = np.diff(old.pr_token_offsets)
+    kept_token_ids = np.asarray(old.pr_token_ids)[np.repeat(old_starts[kept], old_lengths[kept]) +
+                                                  _ranges(old_lengths[kept])]
+
+    cmed_pr_words = ir_med.Vocabulary(list(np.asarray(old.cmed_pr_words)[np.unique(kept_token_ids)]) +
+                                      [tok for tokens in new_pr_tokens.values() for tok in tokens])
+
+    # Presentation tokens: old token IDs are moved to the positions of the words in the new vocabulary
+    remap = np.searchsorted(cmed_pr_words, np.asarray(old.cmed_pr_words)).astype(np.int32)
+    new_ids = {pr: np.searchsorted(cmed_pr_words, tokens).astype(np.int32) for pr, tokens in new_pr_tokens.items()}
+
+    lengths = np.zeros(len(keys), dtype = np.int64)
+    lengths[same] = old_lengths[kept]
+    lengths[~same] = [len(new_ids[pr]) for pr in df_new['apresentacao']]
+
+    pr_token_offsets = np.zeros(len(keys) + 1, dtype = np.int64)
+    pr_token_offsets[1:] = np.cumsum(lengths)
+    pr_token_ids = np.zeros(pr_token_offsets[-1], dtype = np.int32)
+
+    kept_positions = np.repeat(pr_token_offsets[:-1][same], lengths[same]) + _ranges(lengths[same])
+    pr_token_ids[kept_positions] = remap[kept_token_ids]
+    for row, pr in zip(np.flatnonzero(~same), df_new['apresentacao']):
+        pr_token_ids[pr_token_offsets[row]:pr_token_offsets[row + 1]] = new_ids[pr]
+
+    index = CmedIndex(df_cmed, grouped_cmed, cmed_ai_words, cmed_pr_words, pr_token_ids, pr_token_offsets,
+                      dataframe_fingerprint(df_cmed))
+
+    # Ingredients whose rows changed: those of removed and changed rows in the previous release,
+    # and of changed and added rows in the new one
+    removed = np.ones(len(old_keys), dtype = bool)
+    removed[kept] = False
+    new_row_groups = np.empty(len(keys), dtype = np.int64)
+    new_row_groups[grouped_cmed.rows] = np.repeat(np.arange(len(grouped_cmed)), np.diff(grouped_cmed.offsets))
+
+    ingredients = set(np.asarray(old_grouped.keys)[np.unique(old_row_groups[removed])]) | \
+                  set(np.asarray(grouped_cmed.keys)[np.unique(new_row_groups[~same])])
+
+    report = {'added': int((~found).sum()),
+              'changed': int((found & ~same).sum()),
+              'removed': int(len(old_keys) - found.sum()),
+              'unchanged': int(same.sum()),
+              'ingredients': sorted(str(key) for key in ingredients),
+              'previous_rows': previous_rows}
+
+    return _write_index(path, index_dir, index, keys, hashes), report
+
+
+
+# Positions 0..n-1 of every length n in 'lengths', one after the other
+def _ranges(lengths):
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.arange(starts.size) - starts
+
+
+
+# Stores a CmedIndex in 'index_dir', with the keys and raw hashes of its rows, and reads it back
+def _write_index(path, index_dir, index, keys, hashes):
+    stat = os.stat(path)
+    df_cmed = index.df_cmed
+    grouped_cmed = index.grouped_cmed
+
+    ai_codes, ai_uniques = pd.factorize(df_cmed['principio_ativo'])
+    pr_codes, pr_uniques = pd.factorize(df_cmed['apresentacao'])
+
+    manifest = {'format_version': FORMAT_VERSION,
+                'settings_fingerprint': settings_fingerprint(),
+                'source_fingerprint': file_fingerprint(path),
+                'source_size': stat.st_size,
+                'source_mtime_ns': stat.st_mtime_ns,
+                'n_rows': len(df_cmed),
+                'counts': {}}
+
+    # Write everything to a temporary directory and swap it in at the end
+    tmp_dir = index_dir.rstrip(os.sep) + '.tmp-' + str(os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+    os.makedirs(tmp_dir)
+
+    _save_strings(tmp_dir, manifest, 'ai_uniques', ai_uniques)
+    _save_strings(tmp_dir, manifest, 'pr_uniques', pr_uniques)
+    _save_strings(tmp_dir, manifest, 'key', grouped_cmed['key'])
+    _save_strings(tmp_dir, manifest, 'key_sorted', grouped_cmed['key_sorted'])
+    _save_strings(tmp_dir, manifest, 'cmed_ai_words', index.cmed_ai_words)
+    _save_strings(tmp_dir, manifest, 'cmed_pr_words', index.cmed_pr_words)
+    _save_strings(tmp_dir, manifest, 'row_keys', keys)
+
+    np.save(os.path.join(tmp_dir, 'ai_codes.npy'), ai_codes.astype(np.int32))
+    np.save(os.path.join(tmp_dir, 'pr_codes.npy'), pr_codes.astype(np.int32))
+    np.save(os.path.join(tmp_dir, 'index_rows.npy'), grouped_cmed.rows)
+    np.save(os.path.join(tmp_dir, 'index_offsets.npy'), grouped_cmed.offsets)
+    np.save(os.path.join(tmp_dir, 'pr_token_ids.npy'), index.pr_token_ids)
+    np.save(os.path.join(tmp_dir, 'pr_token_offsets.npy'), index.pr_token_offsets)
+    np.save(os.path.join(tmp_dir, 'raw_hashes.npy'), hashes)
+
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+    shutil.rmtree(index_dir, ignore_errors = True)
+    os.replace(tmp_dir, index_dir)
+
+    return _read_index(index_dir, manifest)
+
+
+
+# Loads the index of a CMED release. It is updated when it was built from another release, and
+# rebuilt when it is missing or was built with other settings
+def load_cmed_index(path, index_dir):
+    manifest = _read_manifest(index_dir)
+
+    if manifest is not None and manifest['settings_fingerprint'] == settings_fingerprint():
+        stat = os.stat(path)
+
+        # Only hash the .csv again when its size or modification time changed
+        if (stat.st_size == manifest['source_size'] and stat.st_mtime_ns == manifest['source_mtime_ns']) or \
+            file_fingerprint(path) == manifest['source_fingerprint']:
+
+            return _read_index(index_dir, manifest)
+
+        print("CMED index built from another release, updating")
+        return update_cmed_index(path, index_dir)[0]
+
+    print("CMED index missing or stale, rebuilding")
+    return build_cmed_index(path, index_dir)
+
+
+
+def _read_manifest(index_dir):
+    try:
+        with open(os.path.join(index_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('format_version') != FORMAT_VERSION:
+        return None
+
+    return manifest
+
+
+
+def _read_index(index_dir, manifest):
+    load = lambda name : np.load(os.path.join(index_dir, name + '.npy'), mmap_mode = 'r')
+
+    ai_uniques = np.array(_load_strings(index_dir, manifest, 'ai_uniques'), dtype = object)
+    pr_uniques = np.array(_load_strings(index_dir, manifest, 'pr_uniques'), dtype = object)
+
+    df_cmed = pd.DataFrame({'principio_ativo': ai_uniques[load('ai_codes')],
+                            'apresentacao': pr_uniques[load('pr_codes')]})
+
+    # The rows of each pharmaceutical ingredient are views over a single memory-mapped array
+    grouped_cmed = etl.GroupedCmed(_load_strings(index_dir, manifest, 'key'), _load_strings(index_dir, manifest, 'key_sorted'),
+                                   load('index_rows'), load('index_offsets'))
+
+    cmed_ai_words = ir_med.Vocabulary(_load_strings(index_dir, manifest, 'cmed_ai_words'))
+    cmed_pr_words = ir_med.Vocabulary(_load_strings(index_dir, manifest, 'cmed_pr_words'))
+
+    fingerprint = hashlib.sha256((manifest['source_fingerprint'] + manifest['settings_fingerprint']).encode()).hexdigest()
+
+    return CmedIndex(df_cmed, grouped_cmed, cmed_ai_words, cmed_pr_words,
+                     load('pr_token_ids'), np.asarray(load('pr_token_offsets')), fingerprint)
+
+
+
+# Strings are stored as a single newline separated UTF-8 buffer (preprocessed text has no newlines)
+def _save_strings(index_dir, manifest, name, strings):
+    strings = list(strings)
+    manifest['counts'][name] = len(strings)
+    np.save(os.path.join(index_dir, name + '.npy'), np.frombuffer("\n".join(strings).encode(), dtype = np.uint8))
+
+
+
+def _load_strings(index_dir, manifest, name):
+    if manifest['counts'][name] == 0:
+        return []
+
+    buffer = np.load(os.path.join(index_dir, name + '.npy'), mmap_mode = 'r')
+    return buffer.tobytes().decode().split("\n")
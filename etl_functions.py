@@ -1,359 +1,570 @@
-import nltk
-import numpy as np
-import pandas as pd
+import importlib.util
+import instrumentation as instr
 import re
-from nltk.tokenize import word_tokenize
-from tqdm import tqdm
+import sys
 from unidecode import unidecode
 
 
 
-
-# Load the CMED dataset from a file
-def load_cmed(path, preprocess = False):
+# Imports a module only when one of its attributes is first used. The module is registered in
+# sys.modules, so later 'import name' statements (e.g. in ir_med) get the same lazy module
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+
+# Precompiled patterns used during preprocessing
+RE_NON_WORD = re.compile(r'\W')
+RE_URL_HTTP = re.compile(r'http\S+')
+RE_URL_WWW = re.compile(r'www\S+')
+RE_NUMBERS = re.compile(r'(\d+)')
+RE_DIGIT = re.compile(r'\d')
+
+# Text made only of words and whitespace, as left by the preprocessing
+RE_PLAIN_TEXT = re.compile(r'[\w\s]*')
+
+# Words that nltk's word_tokenize splits after their third letter (Treebank contractions)
+CONTRACTIONS = frozenset(['cannot', 'gimme', 'gonna', 'gotta', 'lemme', 'wanna'])
+
+# Columns of the CMED needed to identify the medicines, and the names given to some of the columns
+CMED_MATCH_COLUMNS = ['principio_ativo', 'apresentacao']
+CMED_COLUMN_NAMES = {'substancia': 'principio_ativo',
+                     'ean 1': 'ean_1',
+                     'ean 2': 'ean_2',
+                     'ean 3': 'ean_3'}
+CMED_EAN_COLUMNS = ['ean_1', 'ean_2', 'ean_3']
+
+# Preprocessing settings applied to the CMED columns 'principio_ativo' and 'apresentacao'
+CMED_AI_PREPROCESSING = {'rem_nums': True, 'rem_stopwords_ai': True, 'correct_ai': True, 'rem_rep_tokens': True}
+CMED_PR_PREPROCESSING = {'rem_stopwords_pr': True}
+CMED_PREPROCESSING = {'principio_ativo': CMED_AI_PREPROCESSING, 'apresentacao': CMED_PR_PREPROCESSING}
+
+# Incorrect writings of pharmaceutical ingredients and their corrections
+CORRECOES = {'acilovir': 'aciclovir',
+             'amoxilina': 'amoxicilina',
+             'benzoilmetronidazol': 'metronidazol',
+             'cabidopa': 'carbidopa',
+             'carvedilo': 'carvedilol',
+             'cetamina': 'escetamina',
+             'clonazepan': 'clonazepam',
+             'deslanosido': 'deslanosideo',
+             'dexamatesona': 'dexametasona',
+             'dexametasoma': 'dexametasona',
+             'dexclorfemiramina': 'dexclorfeniramina',
+             'dexclofeniramina': 'dexclorfeniramina',
+             'dextrocetamina': 'escetamina',
+             'dimenitrato': 'dimenidrinato',
+             'diporina': 'dipirona',
+             'dolantina': 'petidina',
+             'enoxoparina': 'enoxaparina',
+             'espirolactona': 'espironolactona',
+             'estrogeno': 'estrogenios',
+             'estrogenos': 'estrogenios',
+             'folinico': 'folico',
+             'fomoterol': 'formoterol',
+             'hidroclotiazida':'hidroclorotiazida',
+             'hidrocortizona': 'hidrocortisona',
+             'halpperidol': 'haloperidol',
+             'kcl': 'potassio',
+             'meloxican': 'meloxicam',
+             'meropnem': 'meropenem',
+             'metoclopamida': 'metoclopramida',
+             'metroninazol': 'metronidazol',
+             'midazolan': 'midazolam',
+             'nacl': 'sodio',
+             'ondasetrona': 'ondansetrona',
+             'oxcarbamazepin': 'oxcarbazepina',
+             'oxcarbamazepina': 'oxcarbazepina',
+             'oxitocina': 'ocitocina',
+             'piperaciclina': 'piperacilina',
+             'subactant': 'sulbactam',
+             'sulfametazol': 'sulfametoxazol',
+             'tenoxican': 'tenoxicam',
+             'trimetroprima': 'trimetoprima'}
+
+# Words that hinder the identification of pharmaceutical ingredients
+STOPWORDS_AI = {'a', 'acetato', 'acido', 'anidra',
+                'benzatina', 'besilato', 'bicarbonato', 'bidestilada','bissulfato', 'brometo', 'bromidrato', 'bultiprometo',
+                'c', 'calcica', 'carbonato', 'citrato', 'clavulanato', 'cloreto', 'cloridrato', 'com', 'complexo',
+                'd', 'da', 'de', 'di', 'dicloridrato', 'diidratada', 'diidratado', 'dihidratada', 'dihidratado', 'dipropionato', 'dinitrato',
+                    'dissodica', 'dissodico', 'divalproato', 'do', 'dos',
+                'e', 'em', 'enantato', 'esteril', 'estolato',
+                'forma', 'fosfato', 'fumarato',
+                'g',
+                'h', 'hemi', 'hemieptaidratada', 'hemieptaidratado', 'hemifumarato', 'hemiidratado', 'hemipentaidratado', 'hemitartarato', 'heptaidratado',
+                    'hexaidratado', 'hidratada', 'hidratado', 'hidroxido',
+                'lactato', 'longa',
+                'magnesica', 'magnesico', 'maleato', 'membrana', 'mesilato', 'micronizada', 'micronizado', 'monofosfato', 'monohidratada',
+                    'monoidratada', 'monoidratado', 'mononitrato', 'mucato',
+                'n',
+                'o', 'oxalato', 'oxido',
+                'p', 'palmitato', 'para', 'pentahidratado', 'pentaidratada', 'pentaidratado', 'pivoxila', 'potassica',
+                's', 'sem', 'sesquiidratado', 'sodica', 'sodico', 'succinato', 'sulfato',
+                'tartarato', 'tetraidratado', 'tipo', 'tri', 'tribasico', 'triidratada', 'triidratado', 'trihidratada', 'trihidratado',
+                'v', 'valerato', 'valproato',
+                'zincica'}
+
+# Words that hinder the identification of presentations
+STOPWORDS_PR = {'embalagem', 'agua', 'de', 'para', 'sodio', 'e'}
+
+# Abreviation of presentation components based on the ANVISA vocabulary
+ABREVIATOR = {'adaptador': 'adapt',
+              'adesivo': 'ades',
+              'aerossol': 'aer',
+              'agulha': 'agu',
+              'aluminio': 'al',
+              'ambar': 'amb',
+              'ampola': 'amp',
+              'anel': 'anel',
+              'aplicador': 'aplic',
+              'aplicadora': 'aplic',
+              'ativador': 'ativ',
+              'barra': 'bar',
+              'bastao': 'bast',
+              'bisnaga': 'bg',
+              'blister': 'bl',
+              'bolsa': 'bols',
+              'bombeador': 'bomb',
+              'bombona': 'bombo',
+              'bucal': 'buc',
+              'camara': 'cam',
+              'caneta': 'can',
+              'capsula': 'cap',
+              'capilar': 'capi',
+              'carpule': 'car',
+              'conta': 'cgt',
+              'cilindro': 'cil',
+              'colher': 'col',
+              'colutorio': 'colut',
+              'comprimido': 'com',
+              'copo': 'cop',
+              'creme': 'crem',
+              'cartucho': 'ct',
+              'caixa': 'cx',
+              'dermatologica': 'derm',
+              'dermatologico': 'derm',
+              'diluente': 'dil',
+              'diluicao': 'dil',
+              'uterino': 'diu',
+              'dosadora': 'dos',
+              'dura': 'dura',
+              'efervescente': 'efev',
+              'elixir': 'elx',
+              'emplasto': 'empl',
+              'envelope': 'env',
+              'epidural': 'epi',
+              'esmalte': 'esm',
+              'espatula': 'esp',
+              'espuma': 'esp',
+              'espacador': 'espac',
+              'estojo': 'est',
+              'frasco-ampola': 'fa',
+              'fechado': 'fech',
+              'filme': 'fil',
+              'flaconete': 'flac',
+              'frasco': 'fr',
+              'gas': 'gas',
+              'gel': 'gel',
+              'globulo': 'glob',
+              'gomosa': 'gom',
+              'goma': 'goma',
+              'gotas': 'got',
+              'gotejador': 'got',
+              'granulado': 'gran',
+              'articular': 'ia',
+              'arterial': 'iar',
+              'intradermica': 'id',
+              'intramuscular': 'im',
+              'implante': 'impl',
+              'inalacao': 'inal',
+              'inalador': 'inal',
+              'inaladora': 'inal',
+              'inalatoria': 'inal',
+              'infusao': 'infus',
+              'injetavel': 'inj',
+              'irrigacao': 'irr',
+              'intratecal': 'it',
+              'intrauterina': 'iu',
+              'intravenosa': 'iv',
+              'lamina': 'lam',
+              'lenco': 'len',
+              'liberacao': 'lib',
+              'liofilo': 'liof',
+              'liofilizado': 'liof',
+              'liquido': 'liq',
+              'mastigavel': 'mast',
+              'metal': 'met',
+              'emulsao': 'meu',
+              'modificada': 'mod',
+              'mole': 'mole',
+              'nasal': 'nas',
+              'oftalmica': 'oft',
+              'oleo': 'ole',
+              'opaco': 'opc',
+              'oral': 'or',
+              'orodispersivel': 'orodisp',
+              'otologica': 'oto',
+              'ovulo': 'ovl',
+              'papel': 'pap',
+              'pastinha': 'pas',
+              'pasta': 'past',
+              'pincel': 'pinc',
+              'plastico': 'plas',
+              'po': 'po',
+              'pomada': 'pom',
+              'preenchida': 'preenc',
+              'preenchido': 'preenc',
+              'prolongada': 'prol',
+              'pote': 'pt',
+              'rasura': 'ras',
+              'retal': 'ret',
+              'retardada': 'retard',
+              'revestido': 'rev',
+              'sabonete': 'sab',
+              'subcutanea': 'sc',
+              'seringa': 'ser',
+              'sistema': 'sist',
+              'solucao': 'sol',
+              'spray': 'spr',
+              'strip': 'str',
+              'sublingual': 'subl',
+              'supositorio': 'sup',
+              'suspensao': 'sus',
+              'suspencao': 'sus',
+              'tablete': 'table',
+              'tubo': 'tb',
+              'termica': 'term',
+              'transparente': 'trans',
+              'transdermica': 'transd',
+              'transferencia': 'transf',
+              'translucido': 'transl',
+              'uretral': 'uret',
+              'vaginal': 'vag',
+              'valcula': 'valv',
+              'vidro': 'vd',
+              'xampu': 'xamp',
+              'xarope': 'xpe'}
+
+# Units of the strengths and volumes of the presentations, as left by the preprocessing, and the
+# base unit and factor each one is normalized to
+DOSAGE_UNITS = {'mg': ('mg', 1.0),
+                'g': ('mg', 1000.0),
+                'mcg': ('mg', 0.001),
+                'ug': ('mg', 0.001),
+                'ui': ('ui', 1.0),
+                'meq': ('meq', 1.0),
+                'mmol': ('mmol', 1.0),
+                'ml': ('ml', 1.0),
+                'l': ('ml', 1000.0)}
+
+
+
+
+# Load the CMED dataset from a file. If 'columns' is given (e.g. CMED_MATCH_COLUMNS), only those
+# columns are read, the text ones as categories and the EANs as integers, which takes a fraction
+# of the memory and time of reading every column as Python strings
+def load_cmed(path, preprocess = False, columns = None):
     # Load the .csv
-    df_cmed = pd.read_csv(path, sep = ";")
+    if columns is None:
+        df_cmed = pd.read_csv(path, sep = ";")
+    else:
+        header = pd.read_csv(path, sep = ";", nrows = 0).columns
+        usecols = [raw for raw in header if cmed_column_name(raw) in columns]
+
+        df_cmed = pd.read_csv(path, sep = ";", usecols = usecols,
+                              dtype = {raw: str if cmed_column_name(raw) in CMED_EAN_COLUMNS else 'category' for raw in usecols})
 
     # Adjust columns names
-    df_cmed.rename(str.lower, axis = 'columns', inplace = True)
-    df_cmed.rename(unidecode, axis = 'columns', inplace = True)
-    df_cmed.rename(columns = {'substancia': 'principio_ativo',
-                              'ean 1': 'ean_1',
-                              'ean 2': 'ean_2',
-                              'ean 3': 'ean_3'}, inplace = True)
+    df_cmed.rename(cmed_column_name, axis = 'columns', inplace = True)
+
+    for column in CMED_EAN_COLUMNS:
+        if columns is not None and column in df_cmed:
+            df_cmed[column] = pd.to_numeric(df_cmed[column], errors = 'coerce').astype('Int64')
     
     # Apply the preprocess function to the columns 'principio_ativo' and 'apresentacao'
     if preprocess:
         print("Preprocessing CMED")
+        preprocess_cmed(df_cmed)
+
+    return df_cmed
 
-        for idx, row in tqdm(df_cmed.iterrows()):
-            df_cmed.at[idx, 'principio_ativo'] = preprocessing_function(row['principio_ativo'], rem_nums = True, rem_stopwords_ai = True,
-                                                                        correct_ai = True, rem_rep_tokens = True)
-            
-            df_cmed.at[idx, 'apresentacao'] = preprocessing_function(row['apresentacao'], rem_stopwords_pr = True)
+
+
+# Preprocesses the columns 'principio_ativo' and 'apresentacao' of a CMED DataFrame in place
+def preprocess_cmed(df_cmed):
+    for column, settings in CMED_PREPROCESSING.items():
+        if column in df_cmed:
+            df_cmed[column] = preprocess_series(df_cmed[column], **settings)
 
     return df_cmed
 
 
 
+# Returns the same tokens as nltk's word_tokenize. Text with only words and whitespace (all the
+# preprocessed text) is split directly; anything else still goes through nltk
+def tokenize(text):
+    if not RE_PLAIN_TEXT.fullmatch(text):
+        from nltk.tokenize import word_tokenize
+        return word_tokenize(text)
+
+    tokens = text.split()
+
+    if CONTRACTIONS.isdisjoint(tokens if text.islower() else text.lower().split()):
+        return tokens
+
+    return [part for tok in tokens for part in ((tok[:3], tok[3:]) if tok.lower() in CONTRACTIONS else (tok,))]
+
+
+
+# Strengths and volumes written in a preprocessed text, as (unit, value) pairs in the base units of
+# DOSAGE_UNITS: "500 mg" gives ('mg', 500.0), "500 mg ml" ('mg/ml', 500.0), "10 mg g" ('mg/g', 10.0)
+# and "2 5 ml" ('ml', 2.5).
+# The preprocessing splits "2,5" and "100.000" in two numbers, which are read as a decimal, or as
+# thousands when the second one has three digits and the first is not 0
+def parse_dosages(text):
+    tokens = tokenize(text)
+    dosages = []
+
+    for i, tok in enumerate(tokens):
+        if tok not in DOSAGE_UNITS or i == 0 or not tokens[i - 1].isdigit():
+            continue
+
+        integer, fraction = tokens[i - 1], ""
+        if i > 1 and tokens[i - 2].isdigit():
+            integer, fraction = tokens[i - 2], tokens[i - 1]
+
+        if fraction and len(fraction) == 3 and integer.strip('0'):
+            value = float(integer + fraction)
+        elif fraction:
+            value = float(integer + '.' + fraction)
+        else:
+            value = float(integer)
+
+        unit, factor = DOSAGE_UNITS[tok]
+        value *= factor
+
+        # A unit right after the first one is what the strength is given per (mg ml, ui ml, mg g). The
+        # value is kept as written, so that "10 mg g" is still a strength of 10 mg
+        if unit != 'ml' and i + 1 < len(tokens) and tokens[i + 1] in DOSAGE_UNITS:
+            unit = unit + '/' + tokens[i + 1]
+
+        dosages.append((unit, value))
+
+    return dosages
+
+
+
+# Name of a column of the CMED .csv once adjusted (lowercase, without accents)
+def cmed_column_name(raw):
+    name = unidecode(raw.lower())
+    return CMED_COLUMN_NAMES.get(name, name)
+
+
+
+# Columns of the CMED read from the .csv only when first used, e.g. to join the laboratory, EANs
+# or prices to the rows found by predict. They have the same names and dtypes as in
+# load_cmed(path, columns = ...)
+class LazyCmedColumns:
+
+    def __init__(self, path):
+        self.path = path
+        self._columns = {}
+
+    def __getitem__(self, columns):
+        if isinstance(columns, str):
+            return self.load([columns])[columns]
+
+        return self.load(columns)
+
+    # Returns a DataFrame with the given columns, reading the ones not loaded yet
+    def load(self, columns):
+        missing = [column for column in columns if column not in self._columns]
+
+        if missing:
+            self._columns.update(load_cmed(self.path, columns = missing).items())
+
+        return pd.DataFrame({column: self._columns[column] for column in columns})
+
+    # Returns the given columns of the CMED rows 'rows' (e.g. the cmed_indexes of a notice item)
+    def join(self, rows, columns):
+        return self.load(columns).iloc[list(rows)]
+
+
+
 def preprocessing_function(text, correct_ai = False, rem_nums = False, rem_stopwords_ai = False,
                            rem_stopwords_pr = False, abbreviate_prs = True, rem_rep_tokens = False):
     text = text.lower()                   # Apply lowercase
     text = unidecode(text)                # Remove acentuacion
-    text = re.sub('\W',' ', text)         # Removes specials characters and leaves only words
-    text = re.sub(r'http\S+', '', text)   # Removes URLs with http
-    text = re.sub(r'www\S+', '', text)    # Removes URLs with www
+    text = RE_NON_WORD.sub(' ', text)     # Removes specials characters and leaves only words
+    text = RE_URL_HTTP.sub('', text)      # Removes URLs with http
+    text = RE_URL_WWW.sub('', text)       # Removes URLs with www
 
-    tokens = word_tokenize(text)
+    tokens = tokenize(text)
 
     # Correct incorrect writing of pharmaceutical ingredients
     if correct_ai:
-        correcoes = {'acilovir': 'aciclovir',
-                     'amoxilina': 'amoxicilina',
-                     'benzoilmetronidazol': 'metronidazol',
-                     'cabidopa': 'carbidopa',
-                     'carvedilo': 'carvedilol',
-                     'cetamina': 'escetamina',
-                     'clonazepan': 'clonazepam',
-                     'deslanosido': 'deslanosideo',
-                     'dexamatesona': 'dexametasona',
-                     'dexametasoma': 'dexametasona',
-                     'dexclorfemiramina': 'dexclorfeniramina',
-                     'dexclofeniramina': 'dexclorfeniramina',
-                     'dextrocetamina': 'escetamina',
-                     'dimenitrato': 'dimenidrinato',
-                     'diporina': 'dipirona',
-                     'dolantina': 'petidina',
-                     'enoxoparina': 'enoxaparina',
-                     'espirolactona': 'espironolactona',
-                     'estrogeno': 'estrogenios',
-                     'estrogenos': 'estrogenios',
-                     'folinico': 'folico',
-                     'fomoterol': 'formoterol',
-                     'hidroclotiazida':'hidroclorotiazida',
-                     'hidrocortizona': 'hidrocortisona',
-                     'halpperidol': 'haloperidol',
-                     'kcl': 'potassio',
-                     'meloxican': 'meloxicam',
-                     'meropnem': 'meropenem',
-                     'metoclopamida': 'metoclopramida',
-                     'metroninazol': 'metronidazol',
-                     'midazolan': 'midazolam',
-                     'nacl': 'sodio',
-                     'ondasetrona': 'ondansetrona',
-                     'oxcarbamazepin': 'oxcarbazepina',
-                     'oxcarbamazepina': 'oxcarbazepina',
-                     'oxitocina': 'ocitocina',
-                     'piperaciclina': 'piperacilina',
-                     'subactant': 'sulbactam',
-                     'sulfametazol': 'sulfametoxazol',
-                     'tenoxican': 'tenoxicam',
-                     'trimetroprima': 'trimetoprima'}
-        
-        triggers = correcoes.keys()
-        tokens = [correcoes[tok] if tok in triggers else tok for tok in tokens]
+        tokens = [CORRECOES.get(tok, tok) for tok in tokens]
 
     # Insert blank space between numbers and words
-    text = ""
-    for tok in tokens:
-        match = re.split(r'(\d+)', tok)
-        if (len(match) > 1):
-            for m in match:
-                text += m + " "
-        else:
-            text += tok + " "
+    text = RE_NUMBERS.sub(r' \1 ', " ".join(tokens))
 
     # Remove numbers
     if rem_nums:
-        text = re.sub('\d', ' ', text)
+        text = RE_DIGIT.sub(' ', text)
 
-    tokens = word_tokenize(text)
+    tokens = tokenize(text)
 
     # Remove words that hinder the identification of pharmaceutical ingredients
     if rem_stopwords_ai:
-        stopwords_ai = ['a', 'acetato', 'acido', 'anidra',
-                        'benzatina', 'besilato', 'bicarbonato', 'bidestilada','bissulfato', 'brometo', 'bromidrato', 'bultiprometo',
-                        'c', 'calcica', 'carbonato', 'citrato', 'clavulanato', 'cloreto', 'cloridrato', 'com', 'complexo',
-                        'd', 'da', 'de', 'di', 'dicloridrato', 'diidratada', 'diidratado', 'dihidratada', 'dihidratado', 'dipropionato', 'dinitrato',
-                            'dissodica', 'dissodico', 'divalproato', 'do', 'dos',
-                        'e', 'em', 'enantato', 'esteril', 'estolato',
-                        'forma', 'fosfato', 'fumarato',
-                        'g',
-                        'h', 'hemi', 'hemieptaidratada', 'hemieptaidratado', 'hemifumarato', 'hemiidratado', 'hemipentaidratado', 'hemitartarato', 'heptaidratado',
-                            'hexaidratado', 'hidratada', 'hidratado', 'hidroxido',
-                        'lactato', 'longa',
-                        'magnesica', 'magnesico', 'maleato', 'membrana', 'mesilato', 'micronizada', 'micronizado', 'monofosfato', 'monohidratada',
-                            'monoidratada', 'monoidratado', 'mononitrato', 'mucato',
-                        'n',
-                        'o', 'oxalato', 'oxido',
-                        'p', 'palmitato', 'para', 'pentahidratado', 'pentaidratada', 'pentaidratado', 'pivoxila', 'potassica',
-                        's', 'sem', 'sesquiidratado', 'sodica', 'sodico', 'succinato', 'sulfato',
-                        'tartarato', 'tetraidratado', 'tipo', 'tri', 'tribasico', 'triidratada', 'triidratado', 'trihidratada', 'trihidratado',
-                        'v', 'valerato', 'valproato',
-                        'zincica']
-
-        tokens = [tok for tok in tokens if tok not in stopwords_ai]
+        tokens = [tok for tok in tokens if tok not in STOPWORDS_AI]
 
     # Remove words that hinder the identification of presentations
     if rem_stopwords_pr:
-        stopwords_pr = ['embalagem', 'agua', 'de', 'para', 'sodio', 'e']
-        tokens = [tok for tok in tokens if tok not in stopwords_pr]
+        tokens = [tok for tok in tokens if tok not in STOPWORDS_PR]
 
     # Abreviate presentation components based on the ANVISA vocabulary
     if abbreviate_prs:
-        abreviator = {'adaptador': 'adapt',
-                        'adesivo': 'ades',
-                        'aerossol': 'aer',
-                        'agulha': 'agu',
-                        'aluminio': 'al',
-                        'ambar': 'amb',
-                        'ampola': 'amp',
-                        'anel': 'anel',
-                        'aplicador': 'aplic',
-                        'aplicadora': 'aplic',
-                        'ativador': 'ativ',
-                        'barra': 'bar',
-                        'bastao': 'bast',
-                        'bisnaga': 'bg',
-                        'blister': 'bl',
-                        'bolsa': 'bols',
-                        'bombeador': 'bomb',
-                        'bombona': 'bombo',
-                        'bucal': 'buc',
-                        'camara': 'cam',
-                        'caneta': 'can',
-                        'capsula': 'cap',
-                        'capilar': 'capi',
-                        'carpule': 'car',
-                        'conta': 'cgt',
-                        'cilindro': 'cil',
-                        'colher': 'col',
-                        'colutorio': 'colut',
-                        'comprimido': 'com',
-                        'copo': 'cop',
-                        'creme': 'crem',
-                        'cartucho': 'ct',
-                        'caixa': 'cx',
-                        'dermatologica': 'derm',
-                        'dermatologico': 'derm',
-                        'diluente': 'dil',
-                        'diluicao': 'dil',
-                        'uterino': 'diu',
-                        'dosadora': 'dos',
-                        'dura': 'dura',
-                        'efervescente': 'efev',
-                        'elixir': 'elx',
-                        'emplasto': 'empl',
-                        'envelope': 'env',
-                        'epidural': 'epi',
-                        'esmalte': 'esm',
-                        'espatula': 'esp',
-                        'espuma': 'esp',
-                        'espacador': 'espac',
-                        'estojo': 'est',
-                        'frasco-ampola': 'fa',
-                        'fechado': 'fech',
-                        'filme': 'fil',
-                        'flaconete': 'flac',
-                        'frasco': 'fr',
-                        'gas': 'gas',
-                        'gel': 'gel',
-                        'globulo': 'glob',
-                        'gomosa': 'gom',
-                        'goma': 'goma',
-                        'gotas': 'got',
-                        'gotejador': 'got',
-                        'granulado': 'gran',
-                        'articular': 'ia',
-                        'arterial': 'iar',
-                        'intradermica': 'id',
-                        'intramuscular': 'im',
-                        'implante': 'impl',
-                        'inalacao': 'inal',
-                        'inalador': 'inal',
-                        'inaladora': 'inal',
-                        'inalatoria': 'inal',
-                        'infusao': 'infus',
-                        'injetavel': 'inj',
-                        'irrigacao': 'irr',
-                        'intratecal': 'it',
-                        'intrauterina': 'iu',
-                        'intravenosa': 'iv',
-                        'lamina': 'lam',
-                        'lenco': 'len',
-                        'liberacao': 'lib',
-                        'liofilo': 'liof',
-                        'liofilizado': 'liof',
-                        'liquido': 'liq',
-                        'mastigavel': 'mast',
-                        'metal': 'met',
-                        'emulsao': 'meu',
-                        'modificada': 'mod',
-                        'mole': 'mole',
-                        'nasal': 'nas',
-                        'oftalmica': 'oft',
-                        'oleo': 'ole',
-                        'opaco': 'opc',
-                        'oral': 'or',
-                        'orodispersivel': 'orodisp',
-                        'otologica': 'oto',
-                        'ovulo': 'ovl',
-                        'papel': 'pap',
-                        'pastinha': 'pas',
-                        'pasta': 'past',
-                        'pincel': 'pinc',
-                        'plastico': 'plas',
-                        'po': 'po',
-                        'pomada': 'pom',
-                        'preenchida': 'preenc',
-                        'preenchido': 'preenc',
-                        'prolongada': 'prol',
-                        'pote': 'pt',
-                        'rasura': 'ras',
-                        'retal': 'ret',
-                        'retardada': 'retard',
-                        'revestido': 'rev',
-                        'sabonete': 'sab',
-                        'subcutanea': 'sc',
-                        'seringa': 'ser',
-                        'sistema': 'sist',
-                        'solucao': 'sol',
-                        'spray': 'spr',
-                        'strip': 'str',
-                        'sublingual': 'subl',
-                        'supositorio': 'sup',
-                        'suspensao': 'sus',
-                        'suspencao': 'sus',
-                        'tablete': 'table',
-                        'tubo': 'tb',
-                        'termica': 'term',
-                        'transparente': 'trans',
-                        'transdermica': 'transd',
-                        'transferencia': 'transf',
-                        'translucido': 'transl',
-                        'uretral': 'uret',
-                        'vaginal': 'vag',
-                        'valcula': 'valv',
-                        'vidro': 'vd',
-                        'xampu': 'xamp',
-                        'xarope': 'xpe'}
-        forms = abreviator.keys()
-
-        tokens = [abreviator[tok] if tok in forms else tok for tok in tokens]
-
-    # Removal of repeared words
+        tokens = [ABREVIATOR.get(tok, tok) for tok in tokens]
+
+    # Removal of repeared words (keeps the first occurrence of each token)
     if rem_rep_tokens:
-        indexes = np.unique(tokens, return_index=True)[1]
-        tokens = [tokens[index] for index in sorted(indexes)]
+        tokens = list(dict.fromkeys(tokens))
 
     text = " ".join(tokens)
 
     return text
 
 
+
+# Applies preprocessing_function to a whole column at once. CMED and notice columns are highly
+# repetitive, so each distinct value is processed only once and the results are mapped back
+def preprocess_series(series, correct_ai = False, rem_nums = False, rem_stopwords_ai = False,
+                      rem_stopwords_pr = False, abbreviate_prs = True, rem_rep_tokens = False):
+    with instr.stage('preprocess'):
+        codes, uniques = pd.factorize(series, use_na_sentinel = False)
+
+        processed = [preprocessing_function(value, correct_ai = correct_ai, rem_nums = rem_nums,
+                                            rem_stopwords_ai = rem_stopwords_ai, rem_stopwords_pr = rem_stopwords_pr,
+                                            abbreviate_prs = abbreviate_prs, rem_rep_tokens = rem_rep_tokens)
+                     for value in instr.progress(uniques)]
+
+        instr.count('preprocessed_values', len(uniques))
+
+    # Categorical columns stay categorical (distinct values may become equal once preprocessed)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        processed_codes, processed_uniques = pd.factorize(np.array(processed, dtype = object))
+        return pd.Series(pd.Categorical.from_codes(processed_codes[codes], processed_uniques),
+                         index = series.index, name = series.name)
+
+    return pd.Series(np.array(processed, dtype = object)[codes], index = series.index, name = series.name)
+
+
 # Creates a dict like DataFrame where the "keys" are the pharmaceutical ingredients
 # and the "values" are the indexes of CMED rows that have that ingredient
 def grouped_cmed(df_cmed):
+    return build_grouped_cmed(df_cmed).to_frame()
+
+
+
+# CSR like version of grouped_cmed: the sorted keys, a dict from key to its position and the
+# rows of all keys in one flat array, where key i owns rows[offsets[i]:offsets[i+1]]
+class GroupedCmed:
+
+    def __init__(self, keys, keys_sorted, rows, offsets):
+        self.keys = np.asarray(keys)
+        self.keys_sorted = np.asarray(keys_sorted)
+        self.rows = rows
+        self.offsets = np.asarray(offsets)
+        self.key_ids = {key: i for i, key in enumerate(self.keys.tolist())}
 
-    # Create a list with all the distinct pharmaceutical ingredients    
-    ais = np.unique(df_cmed['principio_ativo'])
-    
-    ### Creation of the DataFrame
-    keys = []
-    keys_sorted = []
-    indexes = []
-
-    print("Creation of the grouped-cmed DataFrame")
-    for key in tqdm(ais):
-        # Find the rows of CMED that have the pharmaceutical ingredient stored in key
-        indexes_found = df_cmed.index[df_cmed['principio_ativo'] == key].values
-
-        keys.append(key)
-        keys_sorted.append(sort_alphabetically(key))
-        indexes.append(np.unique(indexes_found))
-    
-    data = {'key': keys,
-            'key_sorted': keys_sorted,
-            'indexes': indexes}
 
-    df_grouped_cmed = pd.DataFrame(data)
+    # Returns the CMED rows of a pharmaceutical ingredient
+    def key_rows(self, key):
+        i = self.key_ids[key]
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
 
-    ### Dealing with duplicated lines
 
-    duplicated = df_grouped_cmed[df_grouped_cmed.duplicated(subset=['key_sorted'], keep=False)]
+    def __len__(self):
+        return len(self.keys)
 
-    keys = []
-    keys_sorted = []
-    indexes = []
 
-    print("Dealing with duplicated pharmaceutical ingredients")
-    for ksort in tqdm(np.unique(duplicated['key_sorted'])):
-        subset = duplicated[duplicated['key_sorted'] == ksort].reset_index(drop = True)
+    # Columns in the same format as the grouped_cmed DataFrame
+    def __getitem__(self, column):
+        if column == 'key':
+            return self.keys
+        if column == 'key_sorted':
+            return self.keys_sorted
+        if column == 'indexes':
+            return [self.rows[self.offsets[i]:self.offsets[i + 1]] for i in range(len(self.keys))]
 
-        keys.append(subset['key'][0])
-        keys_sorted.append(ksort)
-        
-        new_indexes = []
-        for ind in subset['indexes']:
-            new_indexes.extend(ind)
+        raise KeyError(column)
 
-        indexes.append(np.unique(new_indexes))
 
+    # DataFrame view, as returned by grouped_cmed
+    def to_frame(self):
+        return pd.DataFrame({'key': self.keys,
+                             'key_sorted': self.keys_sorted,
+                             'indexes': self['indexes']})
 
-    data = {'key': keys,
-            'key_sorted': keys_sorted,
-            'indexes': indexes}
-    new_lines = pd.DataFrame(data).sort_values(by='key_sorted')
-    df_grouped_cmed.drop_duplicates(subset=['key_sorted'], keep = False, inplace = True)
-    df_grouped_cmed = pd.concat([df_grouped_cmed, new_lines], ignore_index = True)
 
-    return df_grouped_cmed.sort_values(by=['key']).reset_index(drop = True)
+
+# Builds the GroupedCmed of a CMED with a single sort of its rows. Ingredients whose tokens are
+# the same once sorted alphabetically are merged under the first of them in alphabetical order.
+# 'sorted_keys' may hold the sort_alphabetically of ingredients already known
+def build_grouped_cmed(df_cmed, sorted_keys = None):
+    print("Creation of the grouped-cmed index")
+
+    # Distinct pharmaceutical ingredients, in alphabetical order (categories are not sorted by value)
+    codes, ais = pd.factorize(np.asarray(df_cmed['principio_ativo'], dtype = object), sort = True)
+    ais = np.asarray(ais)
+
+    # Group of each ingredient, by its alphabetically sorted tokens
+    sorted_keys = sorted_keys or {}
+    ais_sorted = np.array([sorted_keys[key] if key in sorted_keys else sort_alphabetically(key)
+                           for key in instr.progress(ais)], dtype = object)
+    group_codes, _ = pd.factorize(ais_sorted, sort = True)
+
+    # Each group takes the name of its first ingredient, and groups are ordered by that name
+    first_ai = np.full(group_codes.max() + 1 if len(group_codes) else 0, len(ais))
+    np.minimum.at(first_ai, group_codes, np.arange(len(ais)))
+    group_order = np.argsort(first_ai)
+    group_rank = np.empty_like(group_order)
+    group_rank[group_order] = np.arange(len(group_order))
+
+    # Sort the rows by group and index, dropping repeated indexes
+    row_groups = group_rank[group_codes[codes]]
+    labels = df_cmed.index.values
+    order = np.lexsort((labels, row_groups))
+    row_groups = row_groups[order]
+    labels = labels[order]
+
+    keep = np.ones(len(labels), dtype = bool)
+    keep[1:] = (row_groups[1:] != row_groups[:-1]) | (labels[1:] != labels[:-1])
+    row_groups = row_groups[keep]
+
+    offsets = np.zeros(len(group_order) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(np.bincount(row_groups, minlength = len(group_order)))
+
+    return GroupedCmed(ais[first_ai[group_order]], ais_sorted[first_ai[group_order]].astype(str),
+                       labels[keep].astype(np.int32), offsets)
 
 
 
 # Returns a string with its words in alphabetical order
 def sort_alphabetically(text):
-    tokens = word_tokenize(text)
+    tokens = tokenize(text)
 
     if len(tokens) > 1:
         tokens.sort()
@@ -369,6 +580,24 @@ def load_notice(path, drop_columns, desc_column, und_column, sep = ';', decimal
     # Load the .csv
     df_le = pd.read_csv(path, sep = sep, decimal = decimal)
 
+    if preprocess:
+        print("Pré-processamento do edital")
+
+    return prepare_notice(df_le, drop_columns, desc_column, und_column, preprocess)
+
+
+
+# Reads the .csv of a public notice in chunks of 'chunksize' lines, yielding each chunk with the
+# same adjustments made by load_notice. Only one chunk is held in memory at a time
+def iter_notice(path, drop_columns, desc_column, und_column, sep = ';', decimal = ',', preprocess = False, chunksize = 10000):
+    for df_le in pd.read_csv(path, sep = sep, decimal = decimal, chunksize = chunksize):
+        yield prepare_notice(df_le, drop_columns, desc_column, und_column, preprocess)
+
+
+
+# Adjusts the columns of a notice DataFrame and optionally preprocesses its descriptions
+def prepare_notice(df_le, drop_columns, desc_column, und_column, preprocess = False):
+
     # Adjust columns names
     df_le.drop(columns = drop_columns, inplace = True)
     df_le.rename(str.lower, axis='columns', inplace = True)
@@ -377,26 +606,14 @@ def load_notice(path, drop_columns, desc_column, und_column, sep = ';', decimal
 
     # Apply the preprocess function to the columns 'descrição' and 'unidade'
     if preprocess:
-        print("Pré-processamento do edital")
-        for idx, row in tqdm(df_le.iterrows()):
-            df_le.at[idx, 'original_desc'] = re.sub('\n', '', row['original_desc'])
+        desc_name = df_le.columns[desc_column]
+        und_name = df_le.columns[und_column]
 
-            df_le.at[idx, df_le.columns[desc_column]] = preprocessing_function(row[desc_column], correct_ai = True, rem_rep_tokens = True)
-            
-            df_le.at[idx, df_le.columns[und_column]] = preprocessing_function(row[und_column], rem_stopwords_pr = True)
+        df_le['original_desc'] = df_le['original_desc'].str.replace('\n', '', regex = False)
+        df_le[desc_name] = preprocess_series(df_le[desc_name], correct_ai = True, rem_rep_tokens = True)
+        df_le[und_name] = preprocess_series(df_le[und_name], rem_stopwords_pr = True)
             
     # Creation of the column where the indices of the CMED will be stored
     df_le['cmed_indexes'] = ""
 
     return df_le
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,155 @@
+import etl_functions as etl
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+np = etl.lazy_import('numpy')
+pd = etl.lazy_import('pandas')
+
+
+
+# Evaluation of the predictions against a labeled notice. The labeled DataFrame has, per item:
+#
+#   medicamentos    predicted CMED rows (the cmed_indexes of predict)
+#   pr_encontrado   pharmaceutical ingredient found
+#   desc, und       preprocessed description and unit of the item
+#   string_pr       expected pharmaceutical ingredient
+#   string_apr      expected presentation
+#   quant_matched, quant_grupo, perc_red_conj, desc_orig   copied to the results
+#
+# The checks are the ones of the example notebook, computed over the tokens of each distinct CMED
+# presentation instead of re-tokenizing them for every item
+
+# Columns of the results .csv, in order
+RESULT_COLUMNS = ['Hit', 'quant_matched', 'quant_grupo', 'perc_red_conj', 'desc_orig', 'desc', 'string_pr', 'pr_encontrado',
+                  'right_pr', 'und', 'string_apr', 'common_tokens_apr', 'common_tokens_apr_string', 'right_apr']
+
+# Tokens of string_apr and und that may be missing from the common tokens in a right presentation
+MAX_MISSING_TOKENS = 1
+
+
+
+# Adds to a copy of df_X the columns 'right_pr', 'right_apr', 'common_tokens_apr',
+# 'common_tokens_apr_string' and 'Hit'. With 'workers' > 1 the items are split in chunks of
+# 'chunksize' items evaluated in parallel
+def evaluate(df_X, df_cmed, workers = 1, chunksize = 10000):
+    df_X = df_X.copy()
+    presentations = np.asarray(df_cmed['apresentacao'], dtype = object)
+
+    columns = [df_X['medicamentos'].tolist(), df_X['pr_encontrado'].tolist(), df_X['desc'].tolist(),
+               df_X['string_pr'].tolist(), df_X['string_apr'].tolist(), df_X['und'].tolist()]
+    chunks = [[column[start:start + chunksize] for column in columns] for start in range(0, len(df_X), chunksize)]
+
+    if workers == 1 or len(chunks) <= 1:
+        corpus = PresentationCorpus(presentations)
+        results = [_evaluate_chunk(corpus, *chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers = workers or os.cpu_count(), initializer = _init_worker,
+                                 initargs = (presentations,)) as pool:
+            results = list(pool.map(_evaluate_worker_chunk, chunks))
+
+    for name, values in zip(['right_pr', 'right_apr', 'common_tokens_apr', 'common_tokens_apr_string'], zip(*results)):
+        df_X[name] = [value for chunk in values for value in chunk]
+
+    df_X['Hit'] = df_X['right_pr'] & df_X['right_apr']
+
+    return df_X
+
+
+
+# Hit rates and set reduction statistics of an evaluated DataFrame
+def summary(df_eval):
+    return {'items': len(df_eval),
+            'hit_rate': float(df_eval['Hit'].mean()),
+            'right_pr_rate': float(df_eval['right_pr'].mean()),
+            'right_apr_rate': float(df_eval['right_apr'].mean()),
+            'mean_quant_matched': float(df_eval['quant_matched'].mean()),
+            'mean_quant_grupo': float(df_eval['quant_grupo'].mean()),
+            'mean_perc_red_conj': float(df_eval['perc_red_conj'].mean()),
+            'median_perc_red_conj': float(df_eval['perc_red_conj'].median())}
+
+
+
+# Writes the results .csv with the same columns as the example notebook
+def save_results(df_eval, path):
+    df_eval[RESULT_COLUMNS].to_csv(path, sep = ';', decimal = ',', index = False)
+
+
+
+# Tokens of the distinct presentations of the CMED, each tokenized once
+class PresentationCorpus:
+
+    def __init__(self, presentations):
+        self.codes, self.uniques = pd.factorize(presentations)
+        self.tokens = [etl.tokenize(pr) for pr in self.uniques]
+        self.token_sets = [frozenset(tokens) for tokens in self.tokens]
+
+
+    # Tokens of the first presentation of 'rows' found in every one of them, in order, and the
+    # presentations of 'rows' one per line
+    def common_tokens(self, rows):
+        if not len(rows):
+            return [], ""
+
+        codes = self.codes[rows]
+        distinct = set(codes.tolist())
+        common = self.token_sets[codes[0]].intersection(*[self.token_sets[code] for code in distinct])
+
+        return [tok for tok in self.tokens[codes[0]] if tok in common], "\n".join(self.uniques[codes])
+
+
+
+# The pharmaceutical ingredient is right when every token of the one found is in the description
+# and every token of the expected one is in the one found (both as substrings, as in the notebook)
+def right_pr(descs, prs_found, strings_pr):
+    return [all(tok in desc for tok in etl.tokenize(pr_found)) and all(tok in pr_found for tok in etl.tokenize(string_pr))
+            for desc, pr_found, string_pr in zip(descs, prs_found, strings_pr)]
+
+
+
+# The presentation is right when at most MAX_MISSING_TOKENS tokens of the expected presentation
+# and the unit are missing from the tokens common to every CMED row found
+def right_apr(common_tokens, strings_apr, unds):
+    rights = []
+
+    for common, string_apr, und in zip(common_tokens, strings_apr, unds):
+        common = set(common)
+        missing = sum(tok not in common for tok in etl.tokenize(string_apr)) + sum(tok not in common for tok in etl.tokenize(und))
+        rights.append(missing <= MAX_MISSING_TOKENS)
+
+    return rights
+
+
+
+def _evaluate_chunk(corpus, cmed_indexes, prs_found, descs, strings_pr, strings_apr, unds):
+    common = []
+    common_strings = []
+
+    for rows in cmed_indexes:
+        # Predictions read back from a .csv are strings like "[1, 2]"
+        if isinstance(rows, str):
+            rows = json.loads(rows)
+
+        tokens, string = corpus.common_tokens(np.asarray(rows, dtype = np.int64))
+        common.append(tokens)
+        common_strings.append(string)
+
+    return (right_pr(descs, prs_found, strings_pr),
+            right_apr(common, strings_apr, unds),
+            [" ".join(tokens) for tokens in common],
+            common_strings)
+
+
+
+# Corpus of each worker process
+_worker = {}
+
+
+
+def _init_worker(presentations):
+    _worker['corpus'] = PresentationCorpus(presentations)
+
+
+
+def _evaluate_worker_chunk(chunk):
+    return _evaluate_chunk(_worker['corpus'], *chunk)
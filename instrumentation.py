@@ -0,0 +1,288 @@
+import cProfile
+import json
+import threading
+import time
+
+
+
+# Opt-in instrumentation of the identification process. Functions mark their work with
+#
+#   with instrumentation.stage('match_ai'):
+#       ...
+#   instrumentation.count('ai_candidates', n)
+#
+# and the timings and counters are collected per notice item (instrumentation.item()) and
+# aggregated per notice (instrumentation.notice()), then handed to the enabled sinks. While
+# disabled, stage() returns a shared no-op object and count()/value() return right away
+
+_enabled = False
+_show_progress = True
+_sinks = []
+_scopes = threading.local()
+
+
+
+# Turns the instrumentation on, sending the records to the given sinks
+def enable(*sinks):
+    global _enabled
+    _sinks[:] = sinks
+    _enabled = True
+
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    _sinks[:] = []
+
+
+
+def is_enabled():
+    return _enabled
+
+
+
+# Turns the tqdm progress bars of the loaders on or off
+def set_progress(show):
+    global _show_progress
+    _show_progress = show
+
+
+
+# Wraps an iterable in a progress bar, if they are turned on
+def progress(iterable, **kwargs):
+    if not _show_progress:
+        return iterable
+
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
+
+
+
+class _NullStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+
+class _Stage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _add('timings', self.name, time.perf_counter() - self.start)
+        return False
+
+
+
+# Times the block under 'name'
+def stage(name):
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+
+
+# Adds 'amount' to the counter 'name'
+def count(name, amount = 1):
+    if _enabled:
+        _add('counters', name, amount)
+
+
+
+# Records a measured value (e.g. a similarity) of the current item. Notices keep the mean over the
+# items that recorded it (items served from a cache, for instance, record none)
+def value(name, measured):
+    if _enabled:
+        _add('values', name, measured)
+
+        notice = getattr(_scopes, 'notice', None)
+        if getattr(_scopes, 'item', None) is None and notice is not None:
+            notice['value_counts'][name] = notice['value_counts'].get(name, 0) + 1
+
+
+
+class _Item:
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __enter__(self):
+        self.record = {'type': 'item', 'timings': {}, 'counters': {}, 'values': {}}
+        self.record.update(self.fields)
+        self.parent = getattr(_scopes, 'item', None)
+        _scopes.item = self.record
+        return self
+
+    def __exit__(self, *exc):
+        _scopes.item = self.parent
+
+        notice = getattr(_scopes, 'notice', None)
+        if notice is not None:
+            notice['items'] += 1
+            for kind in ('timings', 'counters', 'values'):
+                for name, amount in self.record[kind].items():
+                    notice[kind][name] = notice[kind].get(name, 0) + amount
+
+            for name in self.record['values']:
+                notice['value_counts'][name] = notice['value_counts'].get(name, 0) + 1
+
+        _emit(self.record)
+        return False
+
+
+
+# Collects the timings and counters of one notice item. Extra fields go into its record
+def item(**fields):
+    return _Item(fields) if _enabled else _NULL_STAGE
+
+
+
+class _Notice:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.record = {'type': 'notice', 'notice': self.name, 'items': 0, 'timings': {}, 'counters': {}, 'values': {},
+                       'value_counts': {}}
+        self.parent = getattr(_scopes, 'notice', None)
+        _scopes.notice = self.record
+
+        for sink in _sinks:
+            sink.notice_started(self.name)
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.record['seconds'] = time.perf_counter() - self.start
+        _scopes.notice = self.parent
+
+        self.record['values'] = {name: total / self.record['value_counts'][name] for name, total in self.record['values'].items()}
+
+        _emit(self.record)
+
+        for sink in _sinks:
+            sink.notice_finished(self.name)
+        return False
+
+
+
+# Aggregates the items processed inside the block as one notice
+def notice(name):
+    return _Notice(name) if _enabled else _NULL_STAGE
+
+
+
+def _add(kind, name, amount):
+    scope = getattr(_scopes, 'item', None)
+
+    if scope is None:
+        scope = getattr(_scopes, 'notice', None)
+
+    # Work done outside any item or notice (e.g. loading the CMED) is reported on its own
+    if scope is None:
+        _emit({'type': kind[:-1], 'name': name, 'amount': amount})
+        return
+
+    scope[kind][name] = scope[kind].get(name, 0) + amount
+
+
+
+def _emit(record):
+    for sink in _sinks:
+        sink.emit(record)
+
+
+
+# Base class of the sinks. They receive every record and the boundaries of each notice
+class Sink:
+
+    def emit(self, record):
+        pass
+
+    def notice_started(self, name):
+        pass
+
+    def notice_finished(self, name):
+        pass
+
+
+
+# Keeps in memory the count, total, minimum and maximum of every timing and counter of the items,
+# the loose stages and counters, and the records of the notices
+class StatsSink(Sink):
+
+    def __init__(self):
+        self.metrics = {}
+        self.notices = []
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            if record['type'] == 'notice':
+                self.notices.append(record)
+            elif record['type'] == 'item':
+                for kind in ('timings', 'counters', 'values'):
+                    for name, amount in record[kind].items():
+                        self._add(name, amount)
+            else:
+                self._add(record['name'], record['amount'])
+
+    def _add(self, name, amount):
+        metric = self.metrics.setdefault(name, {'count': 0, 'total': 0, 'min': amount, 'max': amount})
+        metric['count'] += 1
+        metric['total'] += amount
+        metric['min'] = min(metric['min'], amount)
+        metric['max'] = max(metric['max'], amount)
+
+    def summary(self):
+        return {name: dict(metric, mean = metric['total'] / metric['count']) for name, metric in self.metrics.items()}
+
+
+
+# Writes every record as a line of JSON
+class JsonLinesSink(Sink):
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.file.write(json.dumps(record, default = lambda o : o.item()) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+
+# Runs cProfile while each notice is processed and stores its stats in path_format % notice_number,
+# to be read with pstats
+class ProfileSink(Sink):
+
+    def __init__(self, path_format = 'notice_%d.prof'):
+        self.path_format = path_format
+        self.n_notices = 0
+        self.profiler = None
+
+    def notice_started(self, name):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def notice_finished(self, name):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path_format % self.n_notices)
+        self.n_notices += 1
+        self.profiler = None
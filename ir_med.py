@@ -1,59 +1,246 @@
 import etl_functions as etl
+import instrumentation as instr
 # import math
-import numpy as np
+from collections import Counter, OrderedDict
 from jaro import jaro_winkler_metric
-from nltk.tokenize import word_tokenize
-from tqdm import tqdm
 
+np = etl.lazy_import('numpy')
+pd = etl.lazy_import('pandas')
 
 
-# Return lists with all the tokens present in the columns 'principio ativo' (cmed_ai_words) and 'apresentacao' (cmed_pr_words)
+
+# Return the vocabularies of all the tokens present in the columns 'principio ativo' (cmed_ai_words) and 'apresentacao' (cmed_pr_words)
 def extract_cmed_words(df_cmed):
-    cmed_ai_words = ""
-    cmed_pr_words = ""
-    for _, row in tqdm(df_cmed.iterrows()):
-        cmed_ai_words += row['principio_ativo'] + " "
-        cmed_pr_words += row['apresentacao'] + " "
-
-    cmed_ai_words = np.unique(word_tokenize(cmed_ai_words))
-    cmed_pr_words = np.unique(word_tokenize(cmed_pr_words))
+    with instr.stage('extract_cmed_words'):
+        cmed_ai_words = Vocabulary(tok for text in instr.progress(pd.unique(df_cmed['principio_ativo'])) for tok in etl.tokenize(text))
+        cmed_pr_words = Vocabulary(tok for text in instr.progress(pd.unique(df_cmed['apresentacao'])) for tok in etl.tokenize(text))
     
     return cmed_ai_words, cmed_pr_words
 
 
 
-# Extracts from the column 'desc' of a notice the words that appear in the CMED report
-def sep_desc(desc, cmed_ai_words, cmed_pr_words):
+# Sorted set of words with constant time membership tests. Behaves like the sorted array
+# of the words elsewhere (indexing, iteration, numpy functions)
+class Vocabulary:
+
+    def __init__(self, words):
+        self.word_set = frozenset(words)
+        self.words = np.array(sorted(self.word_set))
+
+    def __contains__(self, word):
+        return word in self.word_set
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __getitem__(self, item):
+        return self.words[item]
+
+    def __array__(self, dtype = None, copy = None):
+        return self.words if dtype is None else self.words.astype(dtype)
+
+    def __repr__(self):
+        return 'Vocabulary(' + repr(self.words) + ')'
+
+
+
+# Extracts from the column 'desc' of a notice the words that appear in the CMED report. If a
+# SpellingCorrector is given, words found in neither vocabulary are corrected first
+def sep_desc(desc, cmed_ai_words, cmed_pr_words, corrector = None):
     desc_ai = ""
     desc_pr = ""
 
-    for tok in word_tokenize(desc):
-        if tok in cmed_ai_words:
-            desc_ai += tok + " "
-        
-        if tok in cmed_pr_words:
-            desc_pr += tok + " "
+    with instr.stage('sep_desc'):
+        for tok in etl.tokenize(desc):
+            if corrector is not None and tok not in cmed_ai_words and tok not in cmed_pr_words:
+                tok = corrector.correct(tok)
+
+            if tok in cmed_ai_words:
+                desc_ai += tok + " "
+            
+            if tok in cmed_pr_words:
+                desc_pr += tok + " "
         
     return desc_ai, desc_pr
 
 
 
+# Applies sep_desc to a whole column of descriptions. Returns the lists of desc_ai and desc_pr
+def sep_desc_batch(descs, cmed_ai_words, cmed_pr_words, corrector = None):
+    if not isinstance(cmed_ai_words, Vocabulary):
+        cmed_ai_words = Vocabulary(np.asarray(cmed_ai_words).tolist())
+    if not isinstance(cmed_pr_words, Vocabulary):
+        cmed_pr_words = Vocabulary(np.asarray(cmed_pr_words).tolist())
+
+    # Repeated descriptions are routed only once
+    routed = {}
+    with instr.stage('sep_desc'):
+        for desc in pd.unique(pd.Series(descs, dtype = object)):
+            tokens = etl.tokenize(desc)
+
+            if corrector is not None:
+                tokens = [tok if tok in cmed_ai_words.word_set or tok in cmed_pr_words.word_set else corrector.correct(tok)
+                          for tok in tokens]
+
+            routed[desc] = ("".join(tok + " " for tok in tokens if tok in cmed_ai_words.word_set),
+                            "".join(tok + " " for tok in tokens if tok in cmed_pr_words.word_set))
+
+    descs_ai = [routed[desc][0] for desc in descs]
+    descs_pr = [routed[desc][1] for desc in descs]
+
+    return descs_ai, descs_pr
+
+
+
+# Spelling correction of notice tokens against the words of the pharmaceutical ingredients, with
+# the symmetric delete method (SymSpell): every word is indexed under the strings left by deleting
+# up to max_distance of its characters, so the candidates of a token are found by looking up its
+# own deletions instead of computing its edit distance to the whole vocabulary. Among the candidates
+# within the allowed distance, the closest wins, then the most frequent, then the first in
+# alphabetical order. The CORRECOES of etl_functions are applied before and take precedence. Salt,
+# form and other stopwords are left as they are: load_cmed strips them from the CMED side, so they
+# are never in the vocabulary, and correcting them would add a second ingredient (sodico -> sodio)
+class SpellingCorrector:
+
+    def __init__(self, word_counts, max_distance = 2, min_length = 5, overrides = None):
+        self.word_counts = dict(word_counts)            # Word -> number of CMED rows where it appears
+        self.max_distance = max_distance
+        self.min_length = min_length                    # Shorter tokens are never corrected
+        self.overrides = etl.CORRECOES if overrides is None else overrides
+        self.deletes = {}
+        self._corrections = {}
+
+        for word in self.word_counts:
+            for variant in _deletes(word, max_distance):
+                self.deletes.setdefault(variant, []).append(word)
+
+
+    # Edit distance accepted for a token: 1 up to 8 characters, max_distance for longer ones
+    def allowed_distance(self, token):
+        return min(self.max_distance, 1 if len(token) <= 8 else 2)
+
+
+    def correct(self, token):
+        if token in self.overrides:
+            return self.overrides[token]
+
+        if token in self.word_counts or len(token) < self.min_length or not token.isalpha():
+            return token
+
+        if token in etl.STOPWORDS_AI or token in etl.STOPWORDS_PR:
+            return token
+
+        if token not in self._corrections:
+            self._corrections[token] = self._lookup(token)
+
+        return self._corrections[token]
+
+
+    def _lookup(self, token):
+        limit = self.allowed_distance(token)
+        best = None
+
+        for variant in _deletes(token, limit):
+            for word in self.deletes.get(variant, ()):
+                if abs(len(word) - len(token)) > limit:
+                    continue
+
+                distance = _osa_distance(token, word)
+                if distance <= limit:
+                    candidate = (distance, -self.word_counts[word], word)
+                    if best is None or candidate < best:
+                        best = candidate
+
+        return token if best is None else best[2]
+
+
+
+# Builds the SpellingCorrector of the pharmaceutical ingredients of a (preprocessed) CMED
+def build_spelling_corrector(df_cmed, max_distance = 2):
+    codes, uniques = pd.factorize(df_cmed['principio_ativo'])
+    rows = np.bincount(codes, minlength = len(uniques))
+
+    word_counts = Counter()
+    for ai, n_rows in zip(uniques, rows):
+        for tok in etl.tokenize(ai):
+            word_counts[tok] += int(n_rows)
+
+    return SpellingCorrector(word_counts, max_distance)
+
+
+
+# Strings obtained from 'word' by deleting up to max_distance characters (the word included)
+def _deletes(word, max_distance):
+    variants = {word}
+    current = {word}
+
+    for _ in range(max_distance):
+        current = {variant[:i] + variant[i + 1:] for variant in current for i in range(len(variant))}
+        variants |= current
+
+    return variants
+
+
+
+# Optimal string alignment distance: insertions, deletions, substitutions and transpositions of
+# adjacent characters
+def _osa_distance(a, b):
+    previous2 = None
+    previous = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+
+        previous2, previous = previous, current
+
+    return previous[len(b)]
+
+
+
 # Macro function that runs the medicine identification process
-def predict(df_cmed, grouped_cmed, desc_ai, desc_pr, und):
+def predict(df_cmed, grouped_cmed, desc_ai, desc_pr, und, ingredient_index = None, presentation_index = None,
+            dosage_index = None):
 
     # Classification of the active_ingredient
-    active_ingredient, _ = match_ai(grouped_cmed, desc_ai)
+    with instr.stage('match_ai'):
+        active_ingredient, ai_metadata = match_ai(grouped_cmed, desc_ai, ingredient_index)
+
+    instr.value('similarity_value', ai_metadata['similarity_value'])
 
     # Coleta dos medicamentos da CMED que possuem o principio ativo apontado
-    df_cmed_filtered = df_cmed.iloc[grouped_cmed[grouped_cmed['key'] == active_ingredient].reset_index()['indexes'][0]]
+    if isinstance(grouped_cmed, etl.GroupedCmed):
+        df_cmed_filtered = df_cmed.iloc[grouped_cmed.key_rows(active_ingredient)]
+    else:
+        df_cmed_filtered = df_cmed.iloc[grouped_cmed[grouped_cmed['key'] == active_ingredient].reset_index()['indexes'][0]]
     
-    return filter_prs(df_cmed_filtered, desc_ai, desc_pr, und, active_ingredient)
+    with instr.stage('filter_prs'):
+        return filter_prs(df_cmed_filtered, desc_ai, desc_pr, und, active_ingredient, presentation_index, dosage_index)
 
 
 
-# Function that predicits the pharmaceutical ingredient
-def match_ai(grouped_cmed, desc_ai):
+# Function that predicits the pharmaceutical ingredient. If an IngredientIndex built from
+# grouped_cmed is given, it is used instead of scanning every row
+def match_ai(grouped_cmed, desc_ai, ingredient_index = None):
     desc_ai = etl.sort_alphabetically(desc_ai)
+
+    if ingredient_index is not None:
+        best_match_key, best_match = ingredient_index.best_match(desc_ai)
+
+        process_metadata = {'desc_ai': desc_ai,
+                            'similarity_value': best_match}
+
+        return (best_match_key, process_metadata)
+
     best_match = -1
     best_match_key = ""
 
@@ -67,6 +254,8 @@ def match_ai(grouped_cmed, desc_ai):
             best_match = metric
             best_match_key = grouped_cmed['key'][i]
 
+    instr.count('ai_candidates', len(grouped_cmed['key_sorted']))
+
     process_metadata = {'desc_ai': desc_ai,
                         'similarity_value': best_match}
 
@@ -74,52 +263,410 @@ def match_ai(grouped_cmed, desc_ai):
 
 
 
-# Function that returns the presentations that have the most intersection with desc_pr
-def filter_prs(df_cmed_filtered, desc_ai, desc_pr, und, active_ingredient):
+# Predicts the pharmaceutical ingredient of many notice items at once. Returns, for each entry of
+# descs_ai, the same (best_match_key, process_metadata) as match_ai. If top_k is given, the
+# metadata also holds the 'top_candidates' as a list of (key, similarity)
+def match_ai_batch(grouped_cmed, descs_ai, top_k = None, tile_size = 1 << 18):
+    descs_ai = [etl.sort_alphabetically(desc_ai) for desc_ai in descs_ai]
+    keys = list(grouped_cmed['key'])
+    keys_sorted = list(grouped_cmed['key_sorted'])
+    rows = np.arange(len(keys))
+
+    # Repeated items of a notice are scored only once
+    distinct = list(dict.fromkeys(descs_ai))
+    best = {}
+
+    # Queries are scored in blocks so the similarity matrix never exceeds tile_size values
+    block_size = max(1, tile_size // max(1, len(keys)))
+
+    instr.count('ai_candidates', len(distinct) * len(keys))
+
+    for start in range(0, len(distinct), block_size):
+        block = distinct[start:start + block_size]
+        scores = jaro_winkler_matrix(block, keys_sorted, tile_size)
+
+        for desc_ai, row_scores in zip(block, scores):
+            if not len(keys):
+                best[desc_ai] = ("", -1, [])
+                continue
+
+            # On ties the last row wins, as in match_ai
+            best_row = len(keys) - 1 - np.argmax(row_scores[::-1])
+            candidates = []
+
+            if top_k:
+                order = np.lexsort((-rows, -row_scores))[:top_k]
+                candidates = [(keys[row], float(row_scores[row])) for row in order]
+
+            best[desc_ai] = (keys[best_row], float(row_scores[best_row]), candidates)
+
+    results = []
+    for desc_ai in descs_ai:
+        best_match_key, best_match, candidates = best[desc_ai]
+
+        process_metadata = {'desc_ai': desc_ai,
+                            'similarity_value': best_match}
+        if top_k:
+            process_metadata['top_candidates'] = candidates
+
+        results.append((best_match_key, process_metadata))
+
+    return results
+
+
+
+# Jaro-Winkler similarity of every string in 'queries' against every string in 'keys', computed
+# with array operations over the encoded characters, tile_size pairs at a time. Gives the same
+# values as jaro_winkler_metric(query, key)
+def jaro_winkler_matrix(queries, keys, tile_size = 1 << 18):
+    scores = np.zeros((len(queries), len(keys)))
+    if not len(queries) or not len(keys):
+        return scores
+
+    alphabet = {char: i for i, char in enumerate(sorted(set("".join(queries)) | set("".join(keys))))}
+
+    # Queries and keys are visited by length so that the tiles carry little padding
+    query_order = np.argsort([len(query) for query in queries], kind = 'stable')
+    key_order = np.argsort([len(key) for key in keys], kind = 'stable')
+    encoded_queries = _encode_strings([queries[i] for i in query_order], alphabet)
+    encoded_keys = _encode_strings([keys[i] for i in key_order], alphabet)
+
+    keys_per_tile = min(len(keys), max(1, tile_size // len(queries)), 1024)
+    queries_per_tile = max(1, tile_size // keys_per_tile)
+
+    for k_start in range(0, len(keys), keys_per_tile):
+        k = np.arange(k_start, min(k_start + keys_per_tile, len(keys)))
+
+        for q_start in range(0, len(queries), queries_per_tile):
+            q = np.arange(q_start, min(q_start + queries_per_tile, len(queries)))
+
+            # All (query, key) pairs of the tile
+            tile_scores = _jaro_winkler_pairs(encoded_queries, np.repeat(q, len(k)), encoded_keys, np.tile(k, len(q)))
+            scores[np.ix_(query_order[q], key_order[k])] = tile_scores.reshape(len(q), len(k))
+
+    return scores
+
+
+
+# Strings up to this length are matched with bit-parallel operations
+MASK_BITS = 64
+
+
+
+# Encodes strings over 'alphabet'. Returns the padded matrix of symbols (-1 as padding), the
+# lengths, whether each of the first characters is a letter (only letters count for the Winkler
+# prefix) and, for each symbol, the bit mask of its positions among the first MASK_BITS chars
+def _encode_strings(strings, alphabet):
+    lens = np.array([len(s) for s in strings], dtype = np.int64)
+    codes = np.full((len(strings), max(1, lens.max())), -1, dtype = np.int64)
+    alpha = np.zeros((len(strings), IngredientIndex.PREFIX_LEN), dtype = bool)
+
+    # The last column stays empty, so the padding symbol -1 has no positions
+    masks = np.zeros((len(strings), len(alphabet) + 1), dtype = np.uint64)
+
+    for i, s in enumerate(strings):
+        codes[i, :len(s)] = [alphabet[char] for char in s]
+        alpha[i, :min(len(s), IngredientIndex.PREFIX_LEN)] = [char.isalpha() for char in s[:IngredientIndex.PREFIX_LEN]]
+
+        for position, symbol in enumerate(codes[i, :min(len(s), MASK_BITS)]):
+            masks[i, symbol] |= np.uint64(1) << np.uint64(position)
+
+    return codes, lens, alpha, masks
+
+
+
+# Vectorized version of jaro.jaro_winkler_metric over the pairs (queries[q], keys[k]).
+# Follows the reference implementation step by step so that the results are bit-identical
+def _jaro_winkler_pairs(queries, q, keys, k):
+    query_codes, query_lens, query_alpha, _ = queries
+    key_codes, key_lens, _, _ = keys
+
+    # The shorter string is s1 (the query, when both have the same length)
+    swap = key_lens[k] < query_lens[q]
+    len1 = np.where(swap, key_lens[k], query_lens[q])
+    len2 = np.where(swap, query_lens[q], key_lens[k])
+
+    num_matches = np.zeros(len(q), dtype = np.int64)
+    half_transposes = np.zeros(len(q), dtype = np.int64)
+
+    for kernel, selected in ((_count_matches_bits, len2 <= MASK_BITS), (_count_matches_bool, len2 > MASK_BITS)):
+        p = np.flatnonzero(selected)
+        if len(p):
+            num_matches[p], half_transposes[p] = kernel(queries, q[p], keys, k[p], swap[p], len1[p], len2[p])
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        similar = num_matches.astype(float)
+        weight = (similar / len1 + similar / len2 + (num_matches - half_transposes // 2) / num_matches) / 3
+
+    weight = np.where(num_matches > 0, weight, 0.0)
+    weight = np.where((len1 == 0) & (len2 == 0), 1.0, weight)
+
+    # Winkler boost for up to PREFIX_LEN leading letters in common
+    limit = np.minimum(len1, IngredientIndex.PREFIX_LEN)
+    prefix = np.ones(len(q), dtype = bool)
+    pre_matches = np.zeros(len(q), dtype = np.int64)
+
+    for i in range(IngredientIndex.PREFIX_LEN):
+        prefix &= (i < limit) & query_alpha[q, i] & \
+                  (query_codes[q, min(i, query_codes.shape[1] - 1)] == key_codes[k, min(i, key_codes.shape[1] - 1)])
+        pre_matches += prefix
+
+    boosted = weight + pre_matches * IngredientIndex.PREFIX_SCALE * (1.0 - weight)
+
+    return np.where(weight > IngredientIndex.BOOST_THRESHOLD, boosted, weight)
+
+
+
+# Symbol at position i of s1 and at positions j of s2 for each pair
+def _symbols_at(queries, q, keys, k, swap, i, j):
+    query_codes = queries[0]
+    key_codes = keys[0]
+
+    s1 = np.where(swap, key_codes[k, min(i, key_codes.shape[1] - 1)], query_codes[q, min(i, query_codes.shape[1] - 1)])
+    s2 = np.where(swap, query_codes[q, np.minimum(j, query_codes.shape[1] - 1)], key_codes[k, np.minimum(j, key_codes.shape[1] - 1)])
+
+    return s1, s2
+
+
+
+# Matching and half transpositions with the positions of s2 held as 64 bit masks
+def _count_matches_bits(queries, q, keys, k, swap, len1, len2):
+    one = np.uint64(1)
+    low_bits = lambda n : np.where(n >= MASK_BITS, ~np.uint64(0), (one << np.minimum(n, MASK_BITS - 1).astype(np.uint64)) - one)
+
+    search_range = np.maximum(len2 // 2 - 1, 0)
+    flags1 = np.zeros((len(q), max(1, len1.max())), dtype = bool)
+    flags2 = np.zeros(len(q), dtype = np.uint64)
+    no_positions = np.zeros(len(q), dtype = np.int64)
+
+    for i in range(flags1.shape[1]):
+        symbol, _ = _symbols_at(queries, q, keys, k, swap, i, no_positions)
+        positions = np.where(swap, queries[3][q, symbol], keys[3][k, symbol])
+
+        # First free position of s2 inside the search range that holds the same char
+        window = low_bits(np.minimum(i + search_range, len2 - 1) + 1) & ~low_bits(np.maximum(i - search_range, 0))
+        candidates = positions & window & ~flags2
+        first = candidates & (~candidates + one)
+
+        flags1[:, i] = candidates != 0
+        flags2 |= first
+
+    # Walk the matched chars of s1 in order, pairing each one with the next matched char of s2
+    half_transposes = np.zeros(len(q), dtype = np.int64)
+
+    for i in range(flags1.shape[1]):
+        first = flags2 & (~flags2 + one)
+        j = np.log2(np.where(first > 0, first, one).astype(float)).astype(np.int64)
+        s1, s2 = _symbols_at(queries, q, keys, k, swap, i, j)
+
+        half_transposes += flags1[:, i] & (s1 != s2)
+        flags2 = np.where(flags1[:, i], flags2 ^ first, flags2)
+
+    return flags1.sum(axis = 1), half_transposes
+
+
+
+# Matching and half transpositions with boolean matrices, for strings longer than MASK_BITS
+def _count_matches_bool(queries, q, keys, k, swap, len1, len2):
+    width1 = max(1, len1.max())
+    width2 = max(1, len2.max())
+    pair_ids = np.arange(len(q))
 
-    sets = get_sets_from_desc_pr(desc_pr)
-    und_sets = get_sets_from_desc_pr(und)
-    sets.extend(und_sets)
+    s1 = np.stack([_symbols_at(queries, q, keys, k, swap, i, pair_ids)[0] for i in range(width1)], axis = 1)
+    s2 = np.stack([_symbols_at(queries, q, keys, k, swap, 0, np.full(len(q), j))[1] for j in range(width2)], axis = 1)
+
+    # Greedy matching of each char of s1 with the first free equal char of s2 inside the search range
+    search_range = np.maximum(len2 // 2 - 1, 0)
+    positions = np.arange(width2)
+    flags1 = np.zeros((len(q), width1), dtype = bool)
+    flags2 = np.zeros((len(q), width2), dtype = bool)
+
+    for i in range(width1):
+        lolim = np.maximum(i - search_range, 0)
+        hilim = np.minimum(i + search_range, len2 - 1)
+
+        candidates = (positions >= lolim[:, None]) & (positions <= hilim[:, None]) & ~flags2 & \
+                     (s2 == s1[:, i:i + 1]) & (i < len1)[:, None]
+
+        found = candidates.any(axis = 1)
+        j = candidates.argmax(axis = 1)
+
+        flags1[found, i] = True
+        flags2[pair_ids[found], j[found]] = True
+
+    num_matches = flags1.sum(axis = 1)
+
+    # Half transpositions: the n-th matched char of s1 against the n-th matched char of s2
+    matched1 = np.take_along_axis(s1, np.argsort(~flags1, axis = 1, kind = 'stable'), axis = 1)
+    matched2 = np.take_along_axis(s2, np.argsort(~flags2, axis = 1, kind = 'stable'), axis = 1)
+    width_matched = min(width1, width2)
+    half_transposes = ((matched1[:, :width_matched] != matched2[:, :width_matched]) &
+                       (np.arange(width_matched) < num_matches[:, None])).sum(axis = 1)
+
+    return num_matches, half_transposes
+
+
+
+# Search index over grouped_cmed['key_sorted'] for the Jaro-Winkler matching of match_ai.
+# Candidates are visited by decreasing upper bound of their similarity and only the ones
+# whose bound can still beat the best score found so far are scored exactly
+class IngredientIndex:
+
+    # Jaro-Winkler parameters used by jaro.jaro_winkler_metric
+    BOOST_THRESHOLD = 0.7
+    PREFIX_LEN = 4
+    PREFIX_SCALE = 0.1
+
+    # Slack so that rounding differences between the bounds and the metric never prune a tie
+    EPS = 1e-9
+
+    def __init__(self, grouped_cmed):
+        self.keys = list(grouped_cmed['key'])
+        self.keys_sorted = list(grouped_cmed['key_sorted'])
+
+        n_keys = len(self.keys_sorted)
+        alphabet = sorted(set("".join(self.keys_sorted)))
+        self.char_ids = {char: i for i, char in enumerate(alphabet)}
+
+        self.lengths = np.array([len(key) for key in self.keys_sorted], dtype = np.int64)
+
+        # Character multiset of every key
+        self.char_counts = np.zeros((n_keys, len(alphabet)), dtype = np.int32)
+
+        # First characters of every key (only letters count for the Winkler prefix)
+        self.prefixes = np.full((n_keys, self.PREFIX_LEN), -1, dtype = np.int32)
+
+        for row, key in enumerate(self.keys_sorted):
+            for char in key:
+                self.char_counts[row, self.char_ids[char]] += 1
+
+            for i, char in enumerate(key[:self.PREFIX_LEN]):
+                if char.isalpha():
+                    self.prefixes[row, i] = self.char_ids[char]
+
+        # Rows grouped by key length, in increasing row order
+        self.buckets = {length: np.flatnonzero(self.lengths == length)[::-1] for length in np.unique(self.lengths)}
+
+
+    # Returns the key with the highest Jaro-Winkler similarity to desc_ai (already sorted
+    # alphabetically) and its similarity. Ties are won by the last row, as in match_ai
+    def best_match(self, desc_ai):
+        best_score = -1
+        best_row = -1
+        scored = 0
+
+        query_counts = np.zeros(len(self.char_ids), dtype = np.int32)
+        for char in desc_ai:
+            if char in self.char_ids:
+                query_counts[self.char_ids[char]] += 1
+
+        query_prefix = np.full(self.PREFIX_LEN, -2, dtype = np.int32)
+        for i, char in enumerate(desc_ai[:self.PREFIX_LEN]):
+            if char.isalpha() and char in self.char_ids:
+                query_prefix[i] = self.char_ids[char]
+
+        # Visit the lengths whose best possible similarity is the highest first
+        lengths = np.array(list(self.buckets.keys()), dtype = np.int64)
+        length_bounds = self._bound(len(desc_ai), lengths, np.minimum(len(desc_ai), lengths),
+                                    np.minimum(self.PREFIX_LEN, np.minimum(len(desc_ai), lengths)))
+
+        for bucket in np.argsort(-length_bounds, kind = 'stable'):
+            if length_bounds[bucket] + self.EPS < best_score:
+                break
+
+            rows = self.buckets[lengths[bucket]]
+
+            common_chars = np.minimum(self.char_counts[rows], query_counts).sum(axis = 1)
+            prefix_matches = np.cumprod(self.prefixes[rows] == query_prefix, axis = 1).sum(axis = 1)
+            bounds = self._bound(len(desc_ai), self.lengths[rows], common_chars, prefix_matches)
+
+            # Rows are stored in decreasing order, so on equal bounds the last row is scored first
+            for i in np.argsort(-bounds, kind = 'stable'):
+                if bounds[i] + self.EPS < best_score:
+                    break
+
+                row = rows[i]
+                metric = jaro_winkler_metric(desc_ai, self.keys_sorted[row])
+                scored += 1
+
+                if metric > best_score or (metric == best_score and row > best_row):
+                    best_score = metric
+                    best_row = row
+
+        instr.count('ai_candidates', scored)
+
+        if best_row == -1:
+            return "", -1
+
+        return self.keys[best_row], best_score
+
+
+    # Upper bound of the Jaro-Winkler similarity between a string of length len_query and
+    # strings of lengths 'lengths', with at most 'common_chars' matching characters and
+    # 'prefix_matches' common leading letters
+    def _bound(self, len_query, lengths, common_chars, prefix_matches):
+        matches = np.minimum(common_chars, np.minimum(len_query, lengths)).astype(float)
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            jaro = (matches / len_query + matches / lengths + 1) / 3
+
+        jaro = np.where(matches > 0, jaro, 0.0)
+        jaro = np.where((lengths == 0) & (len_query == 0), 1.0, jaro)
+
+        return np.where(jaro > self.BOOST_THRESHOLD,
+                        jaro + prefix_matches * self.PREFIX_SCALE * (1.0 - jaro),
+                        jaro)
+
+
+
+# Function that returns the presentations that have the most intersection with desc_pr. Every
+# contiguous sequence of tokens of desc_pr and und (the sets of get_sets_from_desc_pr) found in a
+# presentation counts one, and they are counted without building the sets. If a PresentationIndex
+# of the CMED is given, they are counted with index lookups. If a DosageIndex is given, only the
+# presentations with the strengths and volumes of desc_pr and und are compared
+def filter_prs(df_cmed_filtered, desc_ai, desc_pr, und, active_ingredient, presentation_index = None, dosage_index = None):
+
+    with instr.stage('get_sets'):
+        sequences = [etl.tokenize(desc_pr), etl.tokenize(und)]
+
+    instr.count('sets', sum(len(sequence) * (len(sequence) + 1) // 2 for sequence in sequences))
+    instr.count('cmed_filtered', len(df_cmed_filtered))
+
+    selected = None
+
+    if dosage_index is not None:
+        with instr.stage('filter_dosage'):
+            dosages = etl.parse_dosages(desc_pr) + etl.parse_dosages(und)
+            selected = dosage_index.select(active_ingredient, df_cmed_filtered.index, dosages)
+
+        instr.count('dosage_candidates', int(selected.sum()))
 
     best_count = 0
     best_matchs = []
 
-    for idx_cmed, row_cmed in df_cmed_filtered.iterrows():
+    if presentation_index is not None:
+        # Presentations left out by the dosages are not compared and never match
+        counts = presentation_index.count_sequences(df_cmed_filtered.index, sequences, selected)
 
-        # Check if the presetation has the tokens found in the notice entry
-        count = 0
-        tokens_cmed = word_tokenize(row_cmed['apresentacao'])
+        # Keep every presentation with the highest count (all of them if nothing matched)
+        if len(counts):
+            best_count = max(counts.max(), 0)
+            best_matchs = df_cmed_filtered.index[counts == best_count].tolist()
 
-        for st in sets:
-            
-            # If set only has one token, check if that tokens appears in the CMED presentation
-            if len(st) == 1:
-                if st[0] in tokens_cmed:
-                    count += 1
-
-            # If set has more than a token, check if the sequence of tokens appears, in that order, in the CMED presentation
-            else:
-                if st[0] in tokens_cmed:
-                    check = True
-                    initial_index = tokens_cmed.index(st[0])
-                    
-                    for i in range(1, len(st)):
-                        current_index = (i+initial_index)
-                        
-                        if (current_index >= len(tokens_cmed)) or \
-                            (st[i] != tokens_cmed[current_index]):
-
-                            check = False
-                            break
-                                
-                    if check:
-                        count += 1
-
-        if count > best_count:
-            best_count = count
-            best_matchs = [idx_cmed]
-        elif count == best_count:
-            best_matchs.append(idx_cmed)
+    else:
+        df_candidates = df_cmed_filtered if selected is None else df_cmed_filtered[selected]
+
+        for idx_cmed, row_cmed in df_candidates.iterrows():
+
+            # Check if the presetation has the tokens found in the notice entry
+            tokens_cmed = etl.tokenize(row_cmed['apresentacao'])
+            count = sum(count_contiguous_sets(sequence, tokens_cmed) for sequence in sequences)
+
+            if count > best_count:
+                best_count = count
+                best_matchs = [idx_cmed]
+            elif count == best_count:
+                best_matchs.append(idx_cmed)
 
     process_metadata = {'desc_ai': desc_ai,
                         'desc_pr': desc_pr,
@@ -128,12 +675,270 @@ def filter_prs(df_cmed_filtered, desc_ai, desc_pr, und, active_ingredient):
                         'size_cmed_filtered': len(df_cmed_filtered),
                         'pct_set_reduction': (1 - (len(best_matchs) / len(df_cmed_filtered)))}
 
+    instr.count('presentations_matched', len(best_matchs))
+
     return (best_matchs, process_metadata)
 
 
 
+# Presentations of the CMED stored as arrays of interned token IDs, with an inverted index from
+# each token n-gram, anchored on the first occurrence of its first token, to the presentations
+# where it appears. The inverted indexes are built per set of CMED rows (the rows of an active
+# ingredient) the first time those rows are queried
+class PresentationIndex:
+
+    # Longest n-gram kept in the inverted index. Longer sets are checked against the token arrays
+    NGRAM_MAX = 3
+
+    # Number of inverted indexes kept in memory
+    CACHE_SIZE = 1024
+
+    def __init__(self, words, token_ids, offsets, labels):
+        self.words = list(words)                            # Token of each ID
+        self.word_ids = {word: i for i, word in enumerate(self.words)}
+        self.token_ids = np.asarray(token_ids)              # Tokens of all presentations
+        self.offsets = np.asarray(offsets)                  # Row i owns token_ids[offsets[i]:offsets[i+1]]
+        self.labels = pd.Index(labels)                      # Index labels of the CMED rows
+        self._row_indexes = OrderedDict()
+
+
+    # Returns the token IDs of a CMED row (by position)
+    def row_ids(self, row):
+        return self.token_ids[self.offsets[row]:self.offsets[row + 1]]
+
+
+    # Returns, for each CMED row of 'labels', how many of the sets of get_sets_from_desc_pr for each
+    # token sequence are found in its presentation, with the same rule as filter_prs (the tokens of a
+    # set must appear in order starting at the first occurrence of the set's first token), without
+    # building the sets (see count_contiguous_sets). The sets starting at each token are
+    # looked up from the shortest one, and the longer ones only while some presentation matched.
+    # If 'selected' marks only some of the rows, just those are compared, one by one, and the
+    # others get -1
+    def count_sequences(self, labels, sequences, selected = None):
+        rows = self.labels.get_indexer(labels)
+        postings, first_positions, row_tokens = self._row_index(rows)
+
+        if selected is not None and not selected.all():
+            counts = np.full(len(rows), -1, dtype = np.int64)
+            id_sequences = [tuple(self.word_ids.get(tok, -1) for tok in sequence) for sequence in sequences]
+
+            for local in np.flatnonzero(selected):
+                counts[local] = sum(count_contiguous_sets(ids, row_tokens[local], first_positions[local]) for ids in id_sequences)
+
+            return counts
+
+        counts = np.zeros(len(rows), dtype = np.int64)
+
+        for sequence in sequences:
+            ids = tuple(self.word_ids.get(tok, -1) for tok in sequence)
+
+            for start in range(len(ids)):
+                matched = None
+
+                for n in range(1, min(self.NGRAM_MAX, len(ids) - start) + 1):
+                    matched = postings.get(ids[start:start + n])
+                    if matched is None:
+                        break
+
+                    counts[matched] += 1
+
+                # Sets longer than NGRAM_MAX, extended one token at a time in the token arrays
+                length = self.NGRAM_MAX
+                while matched and start + length < len(ids):
+                    token = ids[start + length]
+                    matched = [local for local in matched
+                               if first_positions[local][ids[start]] + length < len(row_tokens[local]) and
+                               row_tokens[local][first_positions[local][ids[start]] + length] == token]
+                    counts[matched] += 1
+                    length += 1
+
+        return counts
+
+
+    def _row_index(self, rows):
+        key = rows.tobytes()
+
+        if key in self._row_indexes:
+            self._row_indexes.move_to_end(key)
+            return self._row_indexes[key]
+
+        postings = {}
+        first_positions = []
+        row_tokens = []
+
+        for local, row in enumerate(rows):
+            tokens = tuple(self.row_ids(row).tolist())
+            first = {}
+
+            for position, token in enumerate(tokens):
+                first.setdefault(token, position)
+
+            for token, position in first.items():
+                for n in range(1, min(self.NGRAM_MAX, len(tokens) - position) + 1):
+                    postings.setdefault(tokens[position:position + n], []).append(local)
+
+            first_positions.append(first)
+            row_tokens.append(tokens)
+
+        self._row_indexes[key] = (postings, first_positions, row_tokens)
+        if len(self._row_indexes) > self.CACHE_SIZE:
+            self._row_indexes.popitem(last = False)
+
+        return self._row_indexes[key]
+
+
+
+# Builds the PresentationIndex of the column 'apresentacao' of a (preprocessed) CMED
+def build_presentation_index(df_cmed):
+    codes, uniques = pd.factorize(df_cmed['apresentacao'])
+
+    word_ids = {}
+    unique_ids = [np.array([word_ids.setdefault(tok, len(word_ids)) for tok in etl.tokenize(pr)], dtype = np.int32)
+                  for pr in uniques]
+    row_ids = [unique_ids[code] for code in codes]
+
+    offsets = np.zeros(len(row_ids) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([len(ids) for ids in row_ids])
+    token_ids = np.concatenate(row_ids) if row_ids else np.zeros(0, dtype = np.int32)
+
+    return PresentationIndex(word_ids.keys(), token_ids, offsets, df_cmed.index)
+
+
+
+# Strengths and volumes of the CMED presentations (etl.parse_dosages), stored per pharmaceutical
+# ingredient and unit as sorted arrays of values, so the presentations of an ingredient with the
+# dosages of a notice item are found by binary search instead of by comparing their tokens
+class DosageIndex:
+
+    # Relative difference under which two values are the same dosage
+    TOLERANCE = 1e-6
+
+    def __init__(self, keys, units, values, rows, offsets, labels):
+        self.key_ids = {key: i for i, key in enumerate(keys)}
+        self.units = list(units)
+        self.unit_ids = {unit: i for i, unit in enumerate(self.units)}
+        self.values = np.asarray(values)            # Dosage values, sorted within each (ingredient, unit)
+        self.rows = np.asarray(rows)                # CMED row (by position) of each value
+        self.offsets = np.asarray(offsets)          # (ingredient i, unit u) owns values[offsets[g]:offsets[g+1]], g = i * len(units) + u
+        self.labels = pd.Index(labels)              # Index labels of the CMED rows
+        self._positional = self.labels.equals(pd.RangeIndex(len(self.labels)))
+
+        # Units found by a strength without volume: itself and its concentrations ('mg', 'mg/ml', ...)
+        self.strength_units = {unit: [other for other in self.units if other == unit or other.startswith(unit + '/')]
+                               for unit in self.units if unit != 'ml' and '/' not in unit}
+
+
+    # Returns the CMED rows (by position) of the ingredient 'key' with the dosage (unit, value). A
+    # strength written without its volume ("50 mg") finds the same strength with any volume too
+    # ("50 mg" and "50 mg ml"), since notices often leave the volume out
+    def rows_with(self, key, unit, value):
+        if unit not in self.strength_units:
+            return self._rows_with(key, unit, value)
+
+        return np.concatenate([self._rows_with(key, other, value) for other in self.strength_units[unit]])
+
+
+    def _rows_with(self, key, unit, value):
+        if key not in self.key_ids or unit not in self.unit_ids:
+            return self.rows[:0]
+
+        group = self.key_ids[key] * len(self.units) + self.unit_ids[unit]
+        start, end = self.offsets[group], self.offsets[group + 1]
+        if start == end:
+            return self.rows[:0]
+
+        values = self.values[start:end]
+        low = start + values.searchsorted(value * (1 - self.TOLERANCE), side = 'left')
+        high = start + values.searchsorted(value * (1 + self.TOLERANCE), side = 'right')
+
+        return self.rows[low:high]
+
+
+    # Returns which CMED rows of 'labels' (rows of the ingredient 'key') are kept as candidates for
+    # the (unit, value) dosages of a notice item. Each dosage, strengths before volumes, narrows the
+    # candidates to the rows that have it, unless none of them does
+    def select(self, key, labels, dosages):
+        # The labels of a CMED with the default index are already the positions of the rows
+        rows = (np.asarray(labels) if self._positional else self.labels.get_indexer(labels)).tolist()
+        selected = np.ones(len(rows), dtype = bool)
+
+        for unit, value in sorted(dict.fromkeys(dosages), key = lambda dosage : dosage[0] == 'ml'):
+            found = set(self.rows_with(key, unit, value).tolist())
+            matched = selected & np.fromiter((row in found for row in rows), dtype = bool, count = len(rows))
+
+            if matched.any():
+                selected = matched
+
+        return selected
+
+
+
+# Builds the DosageIndex of the column 'apresentacao' of a (preprocessed) CMED, grouped by the
+# pharmaceutical ingredients of grouped_cmed
+def build_dosage_index(df_cmed, grouped_cmed):
+    codes, uniques = pd.factorize(df_cmed['apresentacao'])
+    unique_dosages = [etl.parse_dosages(pr) for pr in uniques]
+
+    units = sorted({unit for dosages in unique_dosages for unit, _ in dosages})
+    unit_ids = {unit: i for i, unit in enumerate(units)}
+
+    keys = list(grouped_cmed['key'])
+    row_keys = np.zeros(len(df_cmed), dtype = np.int64)
+    for i, rows in enumerate(grouped_cmed['indexes']):
+        row_keys[np.asarray(rows, dtype = np.int64)] = i
+
+    # Dosages of each distinct presentation, repeated for every row that has it
+    unique_lengths = np.array([len(dosages) for dosages in unique_dosages], dtype = np.int64)
+    unique_offsets = np.concatenate([[0], np.cumsum(unique_lengths)])
+    unique_units = np.array([unit_ids[unit] for dosages in unique_dosages for unit, _ in dosages], dtype = np.int64)
+    unique_values = np.array([value for dosages in unique_dosages for _, value in dosages], dtype = np.float64)
+
+    lengths = unique_lengths[codes]
+    rows = np.repeat(np.arange(len(df_cmed), dtype = np.int64), lengths)
+    entries = np.repeat(unique_offsets[codes], lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    groups = row_keys[rows] * len(units) + unique_units[entries]
+    values = unique_values[entries]
+
+    order = np.lexsort((rows, values, groups))
+    offsets = np.searchsorted(groups[order], np.arange(len(keys) * len(units) + 1))
+
+    return DosageIndex(keys, units, values[order], rows[order], offsets, df_cmed.index)
+
+
+
+# Number of the sets of get_sets_from_desc_pr for the tokens 'sequence' found in the tokens of a
+# presentation by the rule of filter_prs: a set is found when its tokens appear in order starting
+# at the first occurrence of its first token. The sets starting at sequence[s] found are as many as
+# the tokens that sequence[s:] has in common with the presentation from that first occurrence on,
+# so the count takes one pass over the sequence instead of one per set. 'first' may give the first
+# position of each token of the presentation, if already known
+def count_contiguous_sets(sequence, tokens, first = None):
+    if first is None:
+        first = {}
+        for position, token in enumerate(tokens):
+            first.setdefault(token, position)
+
+    count = 0
+
+    for start, token in enumerate(sequence):
+        if token not in first:
+            continue
+
+        position = first[token]
+        length = 1
+        while start + length < len(sequence) and position + length < len(tokens) and \
+              sequence[start + length] == tokens[position + length]:
+            length += 1
+
+        count += length
+
+    return count
+
+
+
 def get_sets_from_desc_pr(desc_pr):
-    tokens = word_tokenize(desc_pr)
+    tokens = etl.tokenize(desc_pr)
     n_tokens = len(tokens)
 
     func = lambda x : (x**2 + x) / 2    # Calculate the number of sets to create
@@ -0,0 +1,242 @@
+import cmed_index
+import etl_functions as etl
+import instrumentation as instr
+import ir_med
+import os
+import prediction_cache
+import results
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+pd = etl.lazy_import('pandas')
+
+
+
+# Runs the whole identification process over a notice .csv, 'chunksize' lines at a time, and writes
+# the results to 'output_path' as each chunk is done, so memory use does not grow with the notice.
+# 'index' is a cmed_index.CmedIndex and 'cache' an optional prediction_cache.PredictionCache.
+# With correct_spelling, misspelled words are corrected with index.spelling_corrector, and with
+# index.filter_dosage set the presentations are narrowed by the dosages of each item.
+# Returns the number of items processed
+def process_notice(path, index, output_path, drop_columns, desc_column, und_column, sep = ';', decimal = ',',
+                   chunksize = 10000, save_process_metadata = False, cache = None, correct_spelling = False):
+
+    chunks = etl.iter_notice(path, drop_columns, desc_column, und_column, sep = sep, decimal = decimal,
+                             preprocess = True, chunksize = chunksize)
+    chunks = predict_chunks(chunks, index, desc_column, und_column, save_process_metadata, cache, correct_spelling)
+
+    with instr.notice(path):
+        return write_chunks(chunks, output_path)
+
+
+
+# Same as process_notice, with the results written by a results.ResultWriter: a flat table of
+# (item_id, cmed_row) matches and a table of typed process_metadata, '<output_prefix>_matches.csv'
+# and '<output_prefix>_items.csv' (or .parquet). Returns the number of items processed
+def process_notice_results(path, index, output_prefix, drop_columns, desc_column, und_column, sep = ';', decimal = ',',
+                           chunksize = 10000, cache = None, format = 'csv', item_columns = (), correct_spelling = False):
+
+    chunks = etl.iter_notice(path, drop_columns, desc_column, und_column, sep = sep, decimal = decimal,
+                             preprocess = True, chunksize = chunksize)
+    chunks = predict_chunks(chunks, index, desc_column, und_column, save_process_metadata = True, cache = cache,
+                            correct_spelling = correct_spelling)
+
+    with instr.notice(path):
+        return results.write_results(chunks, output_prefix, format, item_columns)
+
+
+
+# Identifies the medicines of each item of the notice chunks, yielding every chunk with its column
+# 'cmed_indexes' filled and, if save_process_metadata is set, one column per process_metadata field
+def predict_chunks(chunks, index, desc_column, und_column, save_process_metadata = False, cache = None, correct_spelling = False):
+    corrector = index.spelling_corrector if correct_spelling else None
+
+    for df_chunk in chunks:
+        descs_ai, descs_pr = ir_med.sep_desc_batch(df_chunk[df_chunk.columns[desc_column]], index.cmed_ai_words,
+                                                   index.cmed_pr_words, corrector)
+
+        cmed_indexes = []
+        metadata = []
+
+        for item, desc_ai, desc_pr, und in zip(df_chunk.index, descs_ai, descs_pr, df_chunk[df_chunk.columns[und_column]]):
+            with instr.item(item = item):
+                if cache is None:
+                    best_matchs, process_metadata = index.predict(desc_ai, desc_pr, und)
+                else:
+                    best_matchs, process_metadata = cache.predict(index, desc_ai, desc_pr, und)
+
+            cmed_indexes.append(best_matchs)
+            metadata.append(process_metadata)
+
+        # The new cache entries of the chunk are saved along with its results
+        if cache is not None:
+            cache.flush()
+
+        df_chunk['cmed_indexes'] = pd.Series(cmed_indexes, index = df_chunk.index, dtype = object)
+
+        if save_process_metadata and metadata:
+            for key in metadata[0]:
+                df_chunk[key] = [process_metadata[key] for process_metadata in metadata]
+
+        yield df_chunk
+
+
+
+# Identifies the medicines of a whole notice loaded with etl.load_notice(..., preprocess = True),
+# filling its column 'cmed_indexes' (and the process_metadata columns, if save_process_metadata
+# is set) with the same results as calling ir_med.sep_desc and index.predict for every row. Items
+# that read the same way to predict are identified once, and they are grouped by pharmaceutical
+# ingredient so that the CMED rows of each ingredient are fetched and indexed once for all of them
+def predict_notice(df_notice, index, desc_column = 'desc', und_column = 'und', save_process_metadata = False,
+                   correct_spelling = False):
+
+    corrector = index.spelling_corrector if correct_spelling else None
+    descs_ai, descs_pr = ir_med.sep_desc_batch(df_notice[desc_column], index.cmed_ai_words, index.cmed_pr_words, corrector)
+    unds = df_notice[und_column].tolist()
+
+    # Distinct items, as the prediction cache sees them
+    item_keys = [prediction_cache.normalize_item(desc_ai, desc_pr, und) for desc_ai, desc_pr, und in zip(descs_ai, descs_pr, unds)]
+    distinct = {}
+    for key, desc_ai, desc_pr, und in zip(item_keys, descs_ai, descs_pr, unds):
+        distinct.setdefault(key, (desc_ai, desc_pr, und))
+
+    # Pharmaceutical ingredient of each distinct desc_ai
+    with instr.stage('match_ai'):
+        ingredients = {}
+        for desc_ai, _, _ in distinct.values():
+            if desc_ai not in ingredients:
+                ingredients[desc_ai] = ir_med.match_ai(index.grouped_cmed, desc_ai, index.ingredient_index)[0]
+
+    groups = {}
+    for key, (desc_ai, _, _) in distinct.items():
+        groups.setdefault(ingredients[desc_ai], []).append(key)
+
+    dosage_index = index.dosage_index if index.filter_dosage else None
+    predictions = {}
+
+    with instr.stage('filter_prs'):
+        for active_ingredient, keys in groups.items():
+            df_cmed_filtered = index.df_cmed.iloc[index.grouped_cmed.key_rows(active_ingredient)]
+
+            for key in keys:
+                desc_ai, desc_pr, und = distinct[key]
+                predictions[key] = ir_med.filter_prs(df_cmed_filtered, desc_ai, desc_pr, und, active_ingredient,
+                                                     index.presentation_index, dosage_index)
+
+    instr.count('notice_items', len(item_keys))
+    instr.count('distinct_items', len(distinct))
+
+    # Back to the rows, with desc_ai and desc_pr reported as each row gave them
+    cmed_indexes = []
+    metadata = []
+    for key, desc_ai, desc_pr in zip(item_keys, descs_ai, descs_pr):
+        best_matchs, process_metadata = predictions[key]
+        cmed_indexes.append(list(best_matchs))
+        metadata.append(dict(process_metadata, desc_ai = desc_ai, desc_pr = desc_pr))
+
+    df_notice['cmed_indexes'] = pd.Series(cmed_indexes, index = df_notice.index, dtype = object)
+
+    if save_process_metadata and metadata:
+        for key in metadata[0]:
+            df_notice[key] = [process_metadata[key] for process_metadata in metadata]
+
+    return df_notice
+
+
+
+# Same as process_notice, with the chunks identified by 'workers' processes (one per core by default).
+# The CMED index stored in 'index_dir' is built from the CMED .csv 'cmed_path' if needed and then
+# memory-mapped by every worker, so it is never pickled. The output is the same as process_notice's
+# (with index.filter_dosage = filter_dosage)
+def process_notice_parallel(path, cmed_path, index_dir, output_path, drop_columns, desc_column, und_column, sep = ';',
+                            decimal = ',', chunksize = 1000, save_process_metadata = False, workers = None, filter_dosage = False):
+
+    cmed_index.load_cmed_index(cmed_path, index_dir)
+    workers = workers or os.cpu_count()
+
+    with _worker_pool(cmed_path, index_dir, workers, filter_dosage) as pool:
+        chunks = _parallel_chunks(pool, 2 * workers, path, drop_columns, desc_column, und_column, sep, decimal, chunksize,
+                                  save_process_metadata)
+
+        with instr.notice(path):
+            return write_chunks(chunks, output_path)
+
+
+
+# Runs process_notice_parallel over every .csv of 'notices_dir' (e.g. data/notices/) with a single pool
+# of workers, writing the results to 'output_dir' under the same file names. Returns the number of
+# items of each notice
+def process_notices(notices_dir, cmed_path, index_dir, output_dir, drop_columns, desc_column, und_column, sep = ';',
+                    decimal = ',', chunksize = 1000, save_process_metadata = False, workers = None, filter_dosage = False):
+
+    cmed_index.load_cmed_index(cmed_path, index_dir)
+    os.makedirs(output_dir, exist_ok = True)
+    workers = workers or os.cpu_count()
+    n_rows = {}
+
+    with _worker_pool(cmed_path, index_dir, workers, filter_dosage) as pool:
+        for name in sorted(os.listdir(notices_dir)):
+            if not name.endswith('.csv'):
+                continue
+
+            path = os.path.join(notices_dir, name)
+            chunks = _parallel_chunks(pool, 2 * workers, path, drop_columns, desc_column, und_column, sep, decimal, chunksize,
+                                      save_process_metadata)
+
+            with instr.notice(path):
+                n_rows[name] = write_chunks(chunks, os.path.join(output_dir, name))
+
+    return n_rows
+
+
+
+# Index loaded by each worker process
+_worker = {}
+
+
+
+def _worker_pool(cmed_path, index_dir, workers, filter_dosage = False):
+    return ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (cmed_path, index_dir, filter_dosage))
+
+
+
+def _init_worker(cmed_path, index_dir, filter_dosage = False):
+    instr.set_progress(False)
+    _worker['index'] = cmed_index.load_cmed_index(cmed_path, index_dir)
+    _worker['index'].filter_dosage = filter_dosage
+
+
+
+# Sends the raw chunks of the notice to the workers and yields them back identified, in the order
+# they were read. At most 'max_pending' chunks are in flight, so memory use stays bounded
+def _parallel_chunks(pool, max_pending, path, drop_columns, desc_column, und_column, sep, decimal, chunksize,
+                     save_process_metadata):
+    pending = deque()
+
+    for df_le in pd.read_csv(path, sep = sep, decimal = decimal, chunksize = chunksize):
+        pending.append(pool.submit(_predict_chunk, df_le, drop_columns, desc_column, und_column, save_process_metadata))
+
+        if len(pending) > max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+
+def _predict_chunk(df_le, drop_columns, desc_column, und_column, save_process_metadata):
+    df_chunk = etl.prepare_notice(df_le, drop_columns, desc_column, und_column, preprocess = True)
+    return next(predict_chunks([df_chunk], _worker['index'], desc_column, und_column, save_process_metadata))
+
+
+
+# Writes the chunks to a .csv one after the other. Returns the number of rows written
+def write_chunks(chunks, output_path, sep = ';', decimal = ','):
+    n_rows = 0
+
+    for df_chunk in chunks:
+        df_chunk.to_csv(output_path, sep = sep, decimal = decimal, index = False,
+                        mode = 'w' if n_rows == 0 else 'a', header = n_rows == 0)
+        n_rows += len(df_chunk)
+
+    return n_rows
@@ -0,0 +1,155 @@
+import etl_functions as etl
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+
+# Memoization of ir_med.predict across notice items, and across runs when a SQLite file is given.
+# Entries are keyed by the CMED index fingerprint and the normalized (desc_ai, desc_pr, und), so
+# items written differently but read the same way by predict share one entry. The SQLite file keeps
+# the entries of the MAX_FINGERPRINTS indexes used last, so processes with different indexes (or
+# options) can share it, and the entries of older CMED releases are dropped. Writes are committed
+# every COMMIT_EVERY entries and on flush and close
+class PredictionCache:
+
+    MAX_FINGERPRINTS = 4
+    COMMIT_EVERY = 1000
+
+    def __init__(self, maxsize = 100000, path = None):
+        self.maxsize = maxsize
+        self.path = path
+        self.fingerprint = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._unsaved = 0
+
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread = False)
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS predictions "
+                             "(fingerprint TEXT, key TEXT, value TEXT, PRIMARY KEY (fingerprint, key))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS fingerprints (fingerprint TEXT PRIMARY KEY, used REAL)")
+            self._db.commit()
+
+
+    # Same as index.predict(desc_ai, desc_pr, und), where index is a cmed_index.CmedIndex
+    def predict(self, index, desc_ai, desc_pr, und):
+        self.set_fingerprint(index.prediction_fingerprint)
+
+        key = normalize_item(desc_ai, desc_pr, und)
+        value = self._get(key)
+
+        if value is None:
+            value = index.predict(desc_ai, desc_pr, und)
+            self._put(key, value)
+
+        best_matchs, process_metadata = value
+
+        # desc_ai and desc_pr are reported as given, like predict does
+        process_metadata = dict(process_metadata, desc_ai = desc_ai, desc_pr = desc_pr)
+
+        return (list(best_matchs), process_metadata)
+
+
+    # Switches the cache to another CMED index. The entries of the indexes beyond the
+    # MAX_FINGERPRINTS used last are deleted from the file
+    def set_fingerprint(self, fingerprint):
+        if fingerprint == self.fingerprint:
+            return
+
+        with self._lock:
+            self.fingerprint = fingerprint
+            self._memory.clear()
+
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?)", (fingerprint, time.time()))
+                self._db.execute("DELETE FROM fingerprints WHERE fingerprint IN "
+                                 "(SELECT fingerprint FROM fingerprints ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                                 (self.MAX_FINGERPRINTS,))
+                self._db.execute("DELETE FROM predictions WHERE fingerprint NOT IN (SELECT fingerprint FROM fingerprints)")
+                self._commit()
+
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'size': len(self._memory)}
+
+
+    # Commits the entries written since the last commit
+    def flush(self):
+        with self._lock:
+            if self._db is not None:
+                self._commit()
+
+
+    def close(self):
+        self.flush()
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM predictions WHERE fingerprint = ? AND key = ?",
+                                       (self.fingerprint, key)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    value = tuple(json.loads(row[0]))
+                    self._remember(key, value)
+                    return value
+
+            self.misses += 1
+            return None
+
+
+    def _put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                                 (self.fingerprint, key, json.dumps(value, default = lambda o : o.item())))
+                self._unsaved += 1
+
+                if self._unsaved >= self.COMMIT_EVERY:
+                    self._commit()
+
+
+    def _commit(self):
+        self._db.commit()
+        self._unsaved = 0
+
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        if len(self._memory) > self.maxsize:
+            self._memory.popitem(last = False)
+
+
+
+# Key of a notice item: desc_ai as match_ai reads it (sorted alphabetically) and the tokens of
+# desc_pr and und, which are all filter_prs looks at
+def normalize_item(desc_ai, desc_pr, und):
+    return json.dumps([etl.sort_alphabetically(desc_ai), etl.tokenize(desc_pr), etl.tokenize(und)])
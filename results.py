@@ -0,0 +1,145 @@
+import etl_functions as etl
+import itertools
+
+np = etl.lazy_import('numpy')
+pd = etl.lazy_import('pandas')
+
+
+
+# Compact output of the predictions, written while the notice is processed. Instead of a column of
+# Python lists, a notice gives two tables:
+#
+#   <prefix>_matches.csv   one (item_id, cmed_row) line per CMED row found for an item
+#   <prefix>_items.csv     one line per item with its typed process_metadata
+#
+# (.parquet instead of .csv with format = 'parquet', which needs pyarrow). item_id is the index of
+# the item in the notice and cmed_row the position of the row in the CMED
+
+MATCH_DTYPES = {'item_id': 'int64', 'cmed_row': 'int32'}
+
+METADATA_DTYPES = {'desc_ai': 'str',
+                   'desc_pr': 'str',
+                   'active_ingredient_found': 'str',
+                   'quant_presentations_matched': 'int32',
+                   'size_cmed_filtered': 'int32',
+                   'pct_set_reduction': 'float64'}
+
+
+
+class ResultWriter:
+
+    def __init__(self, prefix, format = 'csv', item_columns = (), sep = ';', decimal = ','):
+        if format not in ('csv', 'parquet'):
+            raise ValueError("format must be 'csv' or 'parquet'")
+
+        self.prefix = prefix
+        self.format = format
+        self.item_columns = list(item_columns)    # Notice columns copied to the items table (e.g. 'original_desc')
+        self.sep = sep
+        self.decimal = decimal
+        self.n_items = 0
+        self.n_matches = 0
+
+        self._parquet_writers = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+    # Appends a chunk yielded by pipeline.predict_chunks(..., save_process_metadata = True)
+    def write_chunk(self, df_chunk):
+        cmed_indexes = df_chunk['cmed_indexes'].tolist()
+        lengths = np.fromiter(map(len, cmed_indexes), dtype = np.int64, count = len(cmed_indexes))
+
+        matches = pd.DataFrame({'item_id': np.repeat(df_chunk.index.to_numpy(dtype = np.int64), lengths),
+                                'cmed_row': np.fromiter(itertools.chain.from_iterable(cmed_indexes), dtype = np.int32,
+                                                        count = lengths.sum())})
+
+        items = pd.DataFrame({'item_id': df_chunk.index.to_numpy(dtype = np.int64)})
+        for column in self.item_columns:
+            items[column] = df_chunk[column].to_numpy()
+        for column, dtype in METADATA_DTYPES.items():
+            items[column] = df_chunk[column].to_numpy().astype(dtype)
+
+        self._write('matches', matches)
+        self._write('items', items)
+
+        self.n_items += len(items)
+        self.n_matches += len(matches)
+
+
+    def close(self):
+        for writer in self._parquet_writers.values():
+            writer.close()
+
+        self._parquet_writers = {}
+
+
+    def _write(self, table, df):
+        path = result_path(self.prefix, table, self.format)
+
+        if self.format == 'csv':
+            first = (self.n_items == 0)
+            df.to_csv(path, sep = self.sep, decimal = self.decimal, index = False, mode = 'w' if first else 'a', header = first)
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow_table = pa.Table.from_pandas(df, preserve_index = False)
+        if table not in self._parquet_writers:
+            self._parquet_writers[table] = pq.ParquetWriter(path, arrow_table.schema)
+
+        self._parquet_writers[table].write_table(arrow_table)
+
+
+
+def result_path(prefix, table, format = 'csv'):
+    return prefix + '_' + table + '.' + format
+
+
+
+# Writes the chunks of pipeline.predict_chunks (with save_process_metadata = True) as they come.
+# Returns the number of items written
+def write_results(chunks, prefix, format = 'csv', item_columns = (), sep = ';', decimal = ','):
+    with ResultWriter(prefix, format, item_columns, sep, decimal) as writer:
+        for df_chunk in chunks:
+            writer.write_chunk(df_chunk)
+
+    return writer.n_items
+
+
+
+# Reads back one of the tables ('matches' or 'items') written by a ResultWriter
+def read_results(prefix, table, format = 'csv', sep = ';', decimal = ','):
+    path = result_path(prefix, table, format)
+
+    if format == 'parquet':
+        return pd.read_parquet(path)
+
+    dtypes = MATCH_DTYPES if table == 'matches' else dict(METADATA_DTYPES, item_id = 'int64')
+    return pd.read_csv(path, sep = sep, decimal = decimal, dtype = dtypes, keep_default_na = False)
+
+
+
+# Adds to the matches table the given CMED columns (e.g. 'ean_1', 'laboratorio', 'pf sem impostos')
+# of each cmed_row. 'cmed' is an etl.LazyCmedColumns, so only those columns are read from the CMED
+# .csv and only the matched rows are copied
+def join_cmed(matches, cmed, columns):
+    attributes = cmed.join(matches['cmed_row'], columns)
+    attributes.index = matches.index
+
+    return pd.concat([matches, attributes], axis = 1)
+
+
+
+# Rebuilds the lists of CMED rows of each item (the column 'cmed_indexes' of the notice)
+def cmed_indexes(matches, item_ids):
+    grouped = matches.groupby('item_id')['cmed_row'].agg(list)
+    return [grouped.get(item_id, []) for item_id in item_ids]
@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import cmed_index
+import etl_functions as etl
+import instrumentation as instr
+import ir_med
+import json
+import multiprocessing
+import os
+import pipeline
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+pd = etl.lazy_import('pandas')
+
+
+
+# Local HTTP service that keeps the CMED index loaded and answers predict requests:
+#
+#   python server.py --cmed data/cmed.csv --index-dir data/cmed_index --port 8080
+#
+#   POST /predict  {"items": [{"desc": "dipirona 500mg comprimido", "und": "comprimido"}]}
+#   GET  /health
+#   GET  /stats
+#   POST /reload   {"cmed": "data/cmed_2024.csv"}   (or {} to reload the same file)
+#
+# Items are preprocessed like the notices (etl.prepare_notice). Concurrent requests are gathered in
+# micro-batches, which the workers match with a single ir_med.match_ai_batch call
+
+
+
+# The worker processes load the index with pipeline._init_worker
+def _fingerprint():
+    return pipeline._worker['index'].prediction_fingerprint
+
+
+
+# Runs in the workers: preprocesses the (desc, und) items and predicts them, with the index of the
+# worker process or, when the matching runs in a thread, with the given one
+def _predict_items(items, index = None):
+    if index is None:
+        index = pipeline._worker['index']
+
+    descs = etl.preprocess_series(pd.Series([desc for desc, _ in items], dtype = object), correct_ai = True, rem_rep_tokens = True)
+    unds = etl.preprocess_series(pd.Series([und for _, und in items], dtype = object), rem_stopwords_pr = True)
+    descs_ai, descs_pr = ir_med.sep_desc_batch(descs, index.cmed_ai_words, index.cmed_pr_words)
+
+    return index.predict_batch(descs_ai, descs_pr, unds.tolist())
+
+
+
+class QueryServer:
+
+    def __init__(self, cmed_path, index_dir, workers = None, max_batch = 64, batch_wait = 0.005, filter_dosage = False):
+        self.cmed_path = cmed_path
+        self.index_dir = index_dir
+        self.workers = os.cpu_count() if workers is None else workers   # 0 runs the matching in a thread
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.filter_dosage = filter_dosage                              # Narrow the presentations by dosage
+
+        self.pool = None
+        self.index = None           # Index of the pool, when the matching runs in a thread
+        self.fingerprint = None
+        self.started = time.time()
+        self.counters = {'requests': 0, 'items': 0, 'batches': 0, 'errors': 0, 'reloads': 0, 'busy_seconds': 0.0}
+
+        self._queue = None
+        self._reload_lock = None
+
+
+    # Loads the index and starts listening. Returns the asyncio server
+    async def start(self, host = '127.0.0.1', port = 8080):
+        self._queue = asyncio.Queue()
+        self._reload_lock = asyncio.Lock()
+
+        self.pool, self.index, self.fingerprint = await self._load(self.cmed_path)
+        asyncio.get_running_loop().create_task(self._batcher())
+
+        return await asyncio.start_server(self._handle, host, port)
+
+
+    # Predicts the (desc, und) items. Returns one (cmed_indexes, process_metadata) per item
+    async def predict(self, items):
+        loop = asyncio.get_running_loop()
+        futures = []
+
+        for desc, und in items:
+            future = loop.create_future()
+            await self._queue.put((desc, und, future))
+            futures.append(future)
+
+        self.counters['requests'] += 1
+        self.counters['items'] += len(futures)
+
+        return await asyncio.gather(*futures)
+
+
+    # Swaps to the index of another CMED release (or of the same file, if it changed). Requests keep
+    # being answered by the current workers until the new ones are ready
+    async def reload(self, cmed_path = None):
+        async with self._reload_lock:
+            cmed_path = cmed_path or self.cmed_path
+            pool, index, fingerprint = await self._load(cmed_path)
+
+            old_pool = self.pool
+            self.pool, self.index, self.fingerprint, self.cmed_path = pool, index, fingerprint, cmed_path
+            self.counters['reloads'] += 1
+
+            # Batches already sent to the old workers still finish
+            old_pool.shutdown(wait = False)
+
+        return self.fingerprint
+
+
+    def stats(self):
+        batches = self.counters['batches']
+
+        return dict(self.counters,
+                    fingerprint = self.fingerprint,
+                    cmed = self.cmed_path,
+                    workers = self.workers,
+                    queued = self._queue.qsize(),
+                    mean_batch_size = self.counters['items'] / batches if batches else 0.0,
+                    uptime_seconds = time.time() - self.started)
+
+
+    # Brings the stored index up to date in a thread and starts workers with it. Returns the pool,
+    # the index of the pool when it is a thread (None for processes) and the fingerprint
+    async def _load(self, cmed_path):
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, cmed_index.load_cmed_index, cmed_path, self.index_dir)
+
+        # The thread gets the index with every batch, so batches still running on the previous pool
+        # after a reload keep the previous index
+        if self.workers == 0:
+            instr.set_progress(False)
+            index.filter_dosage = self.filter_dosage
+            return ThreadPoolExecutor(max_workers = 1), index, index.prediction_fingerprint
+
+        # Forked from a fresh process, so that the workers do not inherit the listening socket and
+        # the open connections
+        pool = ProcessPoolExecutor(max_workers = self.workers, mp_context = multiprocessing.get_context('forkserver'),
+                                   initializer = pipeline._init_worker, initargs = (cmed_path, self.index_dir, self.filter_dosage))
+
+        # Wait for the workers to load the index before they get any request
+        fingerprints = await asyncio.gather(*[loop.run_in_executor(pool, _fingerprint) for _ in range(self.workers)])
+
+        return pool, None, fingerprints[0]
+
+
+    # Gathers the queued items in batches of up to max_batch items, waiting at most batch_wait
+    # seconds for the batch to fill
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+
+            loop.create_task(self._run_batch(batch))
+
+
+    async def _run_batch(self, batch):
+        start = time.perf_counter()
+        self.counters['batches'] += 1
+
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.pool, _predict_items,
+                                                                       [(desc, und) for desc, und, _ in batch], self.index)
+        except Exception as error:
+            self.counters['errors'] += 1
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            # Futures of requests whose connection was closed are already cancelled
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+        self.counters['busy_seconds'] += time.perf_counter() - start
+
+
+    # Serves the HTTP requests of one connection
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self._route(method, path, body)
+
+                payload = json.dumps(response, default = lambda o : o.item()).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n' %
+                              (status, len(payload), 'keep-alive' if keep_alive else 'close')).encode() + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def _route(self, method, path, body):
+        try:
+            if method == 'GET' and path == '/health':
+                return '200 OK', {'status': 'ok', 'fingerprint': self.fingerprint}
+
+            if method == 'GET' and path == '/stats':
+                return '200 OK', self.stats()
+
+            if method == 'POST' and path == '/predict':
+                request = json.loads(body or b'{}')
+                items = request['items'] if 'items' in request else [request]
+
+                results = await self.predict([(item['desc'], item.get('und', '')) for item in items])
+
+                return '200 OK', {'fingerprint': self.fingerprint,
+                                  'results': [{'cmed_indexes': best_matchs, 'process_metadata': process_metadata}
+                                              for best_matchs, process_metadata in results]}
+
+            if method == 'POST' and path == '/reload':
+                request = json.loads(body or b'{}')
+                return '200 OK', {'fingerprint': await self.reload(request.get('cmed'))}
+
+            return '404 Not Found', {'error': 'unknown endpoint ' + method + ' ' + path}
+
+        except (KeyError, TypeError, ValueError) as error:
+            return '400 Bad Request', {'error': repr(error)}
+        except Exception as error:
+            return '500 Internal Server Error', {'error': repr(error)}
+
+
+
+async def serve(cmed_path, index_dir, host = '127.0.0.1', port = 8080, workers = None, max_batch = 64, batch_wait = 0.005,
+                filter_dosage = False):
+    server = QueryServer(cmed_path, index_dir, workers, max_batch, batch_wait, filter_dosage)
+    listener = await server.start(host, port)
+    print("Serving on http://%s:%d" % (host, port))
+
+    async with listener:
+        await listener.serve_forever()
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Local IR-Med query service")
+    parser.add_argument('--cmed', required = True, help = "CMED .csv")
+    parser.add_argument('--index-dir', required = True, help = "where the CMED index is stored")
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8080)
+    parser.add_argument('--workers', type = int, help = "worker processes (one per core by default, 0 for a thread)")
+    parser.add_argument('--max-batch', type = int, default = 64, help = "most items matched together")
+    parser.add_argument('--batch-wait', type = float, default = 0.005, help = "seconds to wait for a batch to fill")
+    parser.add_argument('--filter-dosage', action = 'store_true', help = "narrow the presentations by the dosages of the items")
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.cmed, args.index_dir, args.host, args.port, args.workers, args.max_batch, args.batch_wait,
+                      args.filter_dosage))
+
+
+
+if __name__ == '__main__':
+    main()